@@ -0,0 +1,51 @@
+"""Compare two JSON reports written by ``benchmarks.run``.
+
+    $ python -m benchmarks.compare before.json after.json
+
+For every backend and operation found in both reports, prints the throughput
+and p99 latency of each run and the ratio between them, so a ratio above 1
+means the second run was faster.
+"""
+import json
+import sys
+
+
+def load(path):
+    with open(path) as f:
+        results = json.load(f)['results']
+    return dict(((r['backend'], r['operation']), r) for r in results)
+
+
+def ratio(before, after):
+    if not before or not after:
+        return None
+    return float(after) / before
+
+
+def ms(seconds):
+    return '-' if seconds is None else '%.3fms' % (seconds * 1000)
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) != 2:
+        sys.stderr.write(__doc__)
+        return 2
+    before, after = load(argv[0]), load(argv[1])
+    fmt = '%-10s %-16s %14s %14s %8s %12s %12s %8s\n'
+    sys.stdout.write(fmt % ('backend', 'operation', 'ops/s before', 'ops/s after',
+                            'speedup', 'p99 before', 'p99 after', 'speedup'))
+    for key in sorted(set(before) & set(after)):
+        b, a = before[key], after[key]
+        throughput = ratio(b['throughput'], a['throughput'])
+        p99 = ratio(a['p99'], b['p99'])
+        sys.stdout.write(fmt % (key[0], key[1],
+                                '%.1f' % (b['throughput'] or 0), '%.1f' % (a['throughput'] or 0),
+                                '%.2fx' % throughput if throughput else '-',
+                                ms(b['p99']), ms(a['p99']),
+                                '%.2fx' % p99 if p99 else '-'))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,281 @@
+"""Benchmarks for the operations of every Taxon backend.
+
+Synthetic data sets are generated with Zipf-distributed tag popularity, so a
+few tags are carried by most items while most tags are rare, as with real
+tagging data. Every operation is timed per call and reported with its
+throughput, latency percentiles, the median latency of the first and last
+tenth of its calls, which should stay flat while the store grows, the peak
+memory of the process and, for Redis, the number of round trips to the
+server. Every backend runs in a process of its own, forked once the data set
+is generated, so its peak memory includes the data set but no other backend.
+
+    $ python -m benchmarks.run --items 100000 --tags 1000 --output before.json
+    $ python -m benchmarks.run --items 100000 --tags 1000 --output after.json
+    $ python -m benchmarks.compare before.json after.json
+
+The Redis backend runs against the server at ``--redis-url``, whose database
+must be empty because it is flushed, or against ``fakeredis`` in process when
+``--redis-url fake`` is given and the package is installed.
+"""
+import bisect
+import json
+import multiprocessing
+import optparse
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import traceback
+
+from taxon import Taxon
+from taxon.backends import BitmapBackend, MemoryBackend, RedisBackend, SQLiteBackend
+from taxon.query import And, Or, Not, Tag
+
+
+class Dataset(object):
+    "A synthetic set of tag assignments with Zipf-distributed tag popularity."
+
+    def __init__(self, items, tags, tags_per_item, skew=1.1, seed=0):
+        self.random = random.Random(seed)
+        self.tags = ['tag-%d' % i for i in xrange(tags)]
+        self.items = ['item-%d' % i for i in xrange(items)]
+        weights = [1.0 / (rank ** skew) for rank in xrange(1, tags + 1)]
+        total = 0.0
+        self._cumulative = []
+        for w in weights:
+            total += w
+            self._cumulative.append(total)
+        self.assignments = {}
+        for item in self.items:
+            count = max(1, int(self.random.expovariate(1.0 / tags_per_item)))
+            for tag in set(self.sample_tag() for _ in xrange(count)):
+                self.assignments.setdefault(tag, []).append(item)
+
+    def sample_tag(self):
+        "Return a tag, drawn according to its popularity."
+        x = self.random.random() * self._cumulative[-1]
+        return self.tags[bisect.bisect(self._cumulative, x)]
+
+    def sample_query(self, depth, width=3):
+        "Return a random query tree of the given depth over popular tags."
+        if depth == 0:
+            return Tag(self.sample_tag())
+        children = [self.sample_query(depth - 1, width) for _ in xrange(width)]
+        op = self.random.choice([And, Or, Or])
+        q = op(*children)
+        if self.random.random() < 0.3:
+            q = And(q, Not(self.sample_query(depth - 1, width)))
+        return q
+
+
+def counting_redis(url):
+    "Return a redis-py client that counts its round trips to the server."
+    import redis
+
+    class CountingConnection(redis.Connection):
+        round_trips = 0
+
+        def send_packed_command(self, command):
+            CountingConnection.round_trips += 1
+            return super(CountingConnection, self).send_packed_command(command)
+
+    client = redis.StrictRedis.from_url(url)
+    kwargs = client.connection_pool.connection_kwargs
+    client.connection_pool = redis.ConnectionPool(connection_class=CountingConnection, **kwargs)
+    client.round_trips = lambda: CountingConnection.round_trips
+    return client
+
+
+def fake_redis():
+    "Return an in-process fake Redis client."
+    import fakeredis
+    client = fakeredis.FakeStrictRedis()
+    client.round_trips = lambda: None
+    return client
+
+
+def make_backend(name, options):
+    if name == 'memory':
+        return MemoryBackend()
+    elif name == 'bitmap':
+        return BitmapBackend()
+    elif name == 'sqlite':
+        return SQLiteBackend(os.path.join(tempfile.mkdtemp(), 'bench.db'), codec=options.codec)
+    elif name == 'redis':
+        if options.redis_url == 'fake':
+            client = fake_redis()
+        else:
+            client = counting_redis(options.redis_url)
+            if client.dbsize() > 0:
+                raise RuntimeError("Redis database %s is not empty" % options.redis_url)
+        return RedisBackend(client, 'bench', codec=options.codec)
+    raise ValueError("Unknown backend %r" % name)
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    k = min(len(sorted_values) - 1, int(round(p / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[k]
+
+
+def peak_memory():
+    "Return the peak resident set size of the process in kilobytes."
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return usage // 1024 if sys.platform == 'darwin' else usage
+
+
+def measure(t, name, calls):
+    """Run every call in ``calls`` against the Taxon instance ``t`` and return
+    its timing report."""
+    redis = getattr(t.backend, 'redis', None)
+    trips_before = redis.round_trips() if redis is not None else None
+    latencies = []
+    start = time.time()
+    for fn, args in calls:
+        call_start = time.time()
+        fn(*args)
+        latencies.append(time.time() - call_start)
+    elapsed = time.time() - start
+    tenth = max(1, len(latencies) // 10)
+    first, last = sorted(latencies[:tenth]), sorted(latencies[-tenth:])
+    latencies.sort()
+    report = {
+        'operation': name,
+        'calls': len(latencies),
+        'seconds': elapsed,
+        'throughput': len(latencies) / elapsed if elapsed else None,
+        'p50': percentile(latencies, 50),
+        'p90': percentile(latencies, 90),
+        'p99': percentile(latencies, 99),
+        'max': latencies[-1] if latencies else None,
+        'p50_first_tenth': percentile(first, 50),
+        'p50_last_tenth': percentile(last, 50),
+        'peak_memory_kb': peak_memory(),
+    }
+    if trips_before is not None:
+        report['round_trips'] = redis.round_trips() - trips_before
+    return report
+
+
+def run_backend(name, data, options):
+    t = Taxon(make_backend(name, options))
+    rng = random.Random(options.seed)
+    batch = options.batch_size
+    reports = []
+    try:
+        tag_calls = []
+        for tag, items in data.assignments.iteritems():
+            for i in xrange(0, len(items), batch):
+                tag_calls.append((t.tag, [tag] + items[i:i + batch]))
+        reports.append(measure(t, 'tag', tag_calls))
+        reports.append(measure(t, 'tags', [(t.tags, [])] * options.repeat))
+        reports.append(measure(t, 'items', [(t.items, [])] * options.repeat))
+        for depth in options.depths:
+            queries = [data.sample_query(depth) for _ in xrange(options.queries)]
+            reports.append(measure(t, 'query-depth-%d' % depth,
+                                   [(t.query, [q]) for q in queries]))
+        untag_calls = []
+        for _ in xrange(options.writes):
+            tag = data.sample_tag()
+            untag_calls.append((t.untag, [tag] + rng.sample(data.assignments[tag],
+                                                           min(batch, len(data.assignments[tag])))))
+        reports.append(measure(t, 'untag', untag_calls))
+        removed = rng.sample(data.items, min(len(data.items), options.writes * batch))
+        remove_calls = [(t.remove, removed[i:i + batch]) for i in xrange(0, len(removed), batch)]
+        reports.append(measure(t, 'remove', remove_calls))
+    finally:
+        t.empty()
+        if isinstance(t.backend, SQLiteBackend):
+            t.backend.close()
+            shutil.rmtree(os.path.dirname(t.backend.path))
+    for report in reports:
+        report['backend'] = name
+    return reports
+
+
+def run_isolated(name, data, options):
+    """Run the benchmarks of a backend in a forked process, so that its peak
+    memory does not include the backends run before it."""
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+
+    def target():
+        try:
+            sender.send((True, run_backend(name, data, options)))
+        except BaseException:
+            sender.send((False, traceback.format_exc()))
+
+    process = multiprocessing.Process(target=target)
+    process.start()
+    sender.close()
+    try:
+        ok, result = receiver.recv()
+    except EOFError:
+        ok, result = False, "the process exited with code %s" % process.exitcode
+    process.join()
+    if not ok:
+        raise RuntimeError("The %s benchmarks failed:\n%s" % (name, result))
+    return result
+
+
+LATENCIES = ('p50', 'p90', 'p99', 'max', 'p50_first_tenth', 'p50_last_tenth')
+
+
+def print_reports(reports, out=sys.stdout):
+    columns = ('backend', 'operation', 'calls', 'throughput', 'p50', 'p90', 'p99',
+               'max', 'p50_first_tenth', 'p50_last_tenth', 'peak_memory_kb', 'round_trips')
+    out.write(''.join('%-16s' % c for c in columns) + '\n')
+    for report in reports:
+        cells = []
+        for c in columns:
+            value = report.get(c)
+            if c in LATENCIES and value is not None:
+                value = '%.3fms' % (value * 1000)
+            elif isinstance(value, float):
+                value = '%.1f' % value
+            cells.append('%-16s' % ('-' if value is None else value))
+        out.write(''.join(cells) + '\n')
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage=__doc__.split('\n\n')[0])
+    parser.add_option('--backend', action='append', dest='backends',
+                      help="memory, bitmap, sqlite or redis; may be repeated (default: all)")
+    parser.add_option('--items', type='int', default=10000)
+    parser.add_option('--tags', type='int', default=200)
+    parser.add_option('--tags-per-item', type='float', default=3.0)
+    parser.add_option('--skew', type='float', default=1.1,
+                      help="exponent of the Zipf distribution of tag popularity")
+    parser.add_option('--batch-size', type='int', default=100,
+                      help="items per tag, untag and remove call")
+    parser.add_option('--queries', type='int', default=200)
+    parser.add_option('--depth', action='append', type='int', dest='depths',
+                      help="query tree depth; may be repeated (default: 0, 1 and 3)")
+    parser.add_option('--writes', type='int', default=50,
+                      help="number of untag and remove calls")
+    parser.add_option('--repeat', type='int', default=5,
+                      help="number of tags and items calls")
+    parser.add_option('--redis-url', default='redis://localhost:6379/15')
+    parser.add_option('--codec', default=None)
+    parser.add_option('--seed', type='int', default=0)
+    parser.add_option('--output', help="write the results as JSON to this file")
+    options, _ = parser.parse_args(argv)
+    options.backends = options.backends or ['memory', 'bitmap', 'sqlite', 'redis']
+    options.depths = options.depths or [0, 1, 3]
+
+    data = Dataset(options.items, options.tags, options.tags_per_item,
+                   options.skew, options.seed)
+    reports = []
+    for name in options.backends:
+        reports.extend(run_isolated(name, data, options))
+    print_reports(reports)
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump({'options': vars(options), 'results': reports}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -19,7 +19,7 @@ setupinfo = dict(
     url='https://github.com/jdp/taxon',
     keywords=['redis', 'key-value', 'store', 'tag', 'taxonomy'],
     include_package_data=True,
-    packages=find_packages(exclude=('tests', 'docs')),
+    packages=find_packages(exclude=('tests', 'docs', 'benchmarks')),
     license=license,
     requires=['redis'],
     classifiers=[
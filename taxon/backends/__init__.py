@@ -1,3 +1,8 @@
 from .backend import Backend
-from .memory import MemoryBackend
+from .bitmap import BitmapBackend
+from .memory import ConcurrentMemoryBackend, MemoryBackend
+from .parallel import ParallelMemoryBackend
 from .redis import RedisBackend
+from .sharded import ShardedRedisBackend
+from .snapshot import SnapshotBackend
+from .sqlite import SQLiteBackend
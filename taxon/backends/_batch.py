@@ -0,0 +1,69 @@
+"""Evaluation of batches of queries as vectorized bit operations.
+
+The tags referenced by a batch are loaded into a matrix with one bit-packed
+row per tag and one bit per item, and every distinct node of the batch's
+canonical query trees is computed once, with NumPy, as a row of that matrix.
+Requires the numpy package; ``numpy`` is ``None`` here when it is missing.
+"""
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from ..query import canonical, query_tags
+
+if numpy is not None:
+    _POPCOUNT = numpy.array([bin(i).count('1') for i in xrange(256)], dtype=numpy.uint16)
+
+
+def evaluate_many(queries, tagged, universe, count=False):
+    """Return the list of items matching each query in ``queries``, or their
+    number with ``count``, given ``tagged``, a mapping of tags to sets of
+    items, and ``universe``, the set of all items."""
+    trees = [canonical(q) for q in queries]
+    items = list(universe)
+    index = dict((item, i) for i, item in enumerate(items))
+    tags = set()
+    for tree in trees:
+        tags.update(query_tags(tree))
+    rows = {}
+    matrix = numpy.zeros((len(tags), (len(items) + 7) // 8), dtype=numpy.uint8)
+    members = numpy.zeros(len(items), dtype=bool)
+    for row, tag in enumerate(tags):
+        rows[tag] = row
+        members[:] = False
+        members[[index[item] for item in tagged.get(tag, ())]] = True
+        matrix[row] = numpy.packbits(members)
+    everything = numpy.packbits(numpy.ones(len(items), dtype=bool))
+
+    memo = {}
+
+    def evaluate(node):
+        bits = memo.get(node)
+        if bits is not None:
+            return bits
+        fn, args = node
+        if fn == 'tag':
+            bits = matrix[rows[args[0]]]
+        elif fn == 'and':
+            bits = numpy.bitwise_and.reduce([evaluate(a) for a in args])
+        elif fn == 'or':
+            bits = numpy.bitwise_or.reduce([evaluate(a) for a in args])
+        elif fn == 'not':
+            bits = everything & ~evaluate(args[0])
+        elif fn == 'diff':
+            bits = evaluate(args[0]) & ~numpy.bitwise_or.reduce([evaluate(a) for a in args[1:]])
+        else:
+            raise ValueError
+        memo[node] = bits
+        return bits
+
+    results = []
+    for tree in trees:
+        bits = evaluate(tree)
+        if count:
+            results.append(int(_POPCOUNT[bits].sum()))
+        else:
+            ids = numpy.flatnonzero(numpy.unpackbits(bits)[:len(items)])
+            results.append([items[i] for i in ids])
+    return results
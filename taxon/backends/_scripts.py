@@ -0,0 +1,344 @@
+"""Lua scripts run by the Redis backend.
+
+Every script starts with the cache prelude, so ``KEYS[1]`` to ``KEYS[3]`` are
+always the ``cache:lru`` zset, the cache dependency hash and the cache statistics
+hash, and the script's own keys follow from ``KEYS[4]``.
+
+Cached results are members of the cache zset, scored by a logical clock kept
+in the statistics hash so that the lowest scores are the least recently used.
+The cache dependency hash maps every cached result to the JSON list of the
+dependency sets it was added to: one ``deps:<tag>`` set per tag it read, and
+``universe:deps`` when it read the universe of items through a ``not``.
+
+The universe of items is the ``universe`` set, which the write scripts keep
+in step with the ``items`` counters: an item is added to it when its count
+becomes positive and removed from it when the count drops to zero.
+"""
+
+CACHE = """
+local cache_key, cache_deps_key, cache_stats_key = KEYS[1], KEYS[2], KEYS[3]
+
+local function drop(key)
+    redis.call('DEL', key)
+    redis.call('ZREM', cache_key, key)
+    local deps = redis.call('HGET', cache_deps_key, key)
+    if deps then
+        for _, dep in ipairs(cjson.decode(deps)) do
+            redis.call('SREM', dep, key)
+        end
+        redis.call('HDEL', cache_deps_key, key)
+    end
+end
+
+local function invalidate(dep)
+    local keys = redis.call('SMEMBERS', dep)
+    for _, key in ipairs(keys) do
+        drop(key)
+    end
+    if #keys > 0 then
+        redis.call('DEL', dep)
+        redis.call('HINCRBY', cache_stats_key, 'invalidations', #keys)
+    end
+end
+"""
+
+# Evaluates a whole query tree on the server in one round trip. The tree is
+# a JSON array of ``[fn, key, children]`` nodes, with ``['tag', key, tag]``
+# for tags, where the key and tag are hex encoded so that tags can hold any
+# bytes. Every result is stored in its precomputed key and cached along
+# with its dependencies, then the least recently used results are evicted
+# down to the size bound. Returns the root key along with its members, its
+# cardinality when the mode is ``count``, one SSCAN page of its members when
+# the mode is ``scan``, or the tags of its members and how many members carry
+# each when the mode is ``facets``, followed by the number of cache hits and
+# misses. Facets are counted for the tags in ARGV[9..], or for every tag
+# found through the reverse index of the members when none are given.
+QUERY = CACHE + """
+local universe_key = KEYS[4]
+local deps_prefix, universe_deps_key = ARGV[1], ARGV[2]
+local ttl, size = tonumber(ARGV[3]), tonumber(ARGV[4])
+local tree, mode = cjson.decode(ARGV[5]), ARGV[6]
+local clock = redis.call('HINCRBY', cache_stats_key, 'clock', 1)
+local hits, misses = 0, 0
+
+local function store(cmd, dest, keys)
+    for i = 1, #keys, 1000 do
+        local chunk = {unpack(keys, i, math.min(i + 999, #keys))}
+        if i > 1 then
+            table.insert(chunk, 1, dest)
+        end
+        redis.call(cmd, dest, unpack(chunk))
+    end
+end
+
+local function lookup(key)
+    if redis.call('EXISTS', key) == 0 then
+        return nil
+    end
+    local deps = redis.call('HGET', cache_deps_key, key)
+    if not deps then
+        return nil
+    end
+    redis.call('ZADD', cache_key, clock, key)
+    redis.call('HINCRBY', cache_stats_key, 'hits', 1)
+    hits = hits + 1
+    return cjson.decode(deps)
+end
+
+local function remember(key, deps)
+    if redis.call('EXISTS', key) == 0 then
+        return
+    end
+    redis.call('ZADD', cache_key, clock, key)
+    redis.call('HSET', cache_deps_key, key, cjson.encode(deps))
+    for _, dep in ipairs(deps) do
+        redis.call('SADD', dep, key)
+    end
+    if ttl > 0 then
+        redis.call('EXPIRE', key, ttl)
+    end
+end
+
+local function unhex(s)
+    return (s:gsub('..', function(h) return string.char(tonumber(h, 16)) end))
+end
+
+-- Puts the tags of an intersection first, smallest first, so that an empty
+-- tag ends it before any subtree is computed
+local function order(children)
+    local tags, ordered = {}, {}
+    for _, child in ipairs(children) do
+        if child[1] == 'tag' then
+            tags[#tags + 1] = {redis.call('SCARD', unhex(child[2])), child}
+        end
+    end
+    table.sort(tags, function(a, b) return a[1] < b[1] end)
+    for _, tag in ipairs(tags) do
+        ordered[#ordered + 1] = tag[2]
+    end
+    for _, child in ipairs(children) do
+        if child[1] ~= 'tag' then
+            ordered[#ordered + 1] = child
+        end
+    end
+    return ordered
+end
+
+local function evaluate(node)
+    local fn, key, children = node[1], node[2], node[3]
+    if fn == 'tag' then
+        return unhex(key), {deps_prefix .. unhex(children)}
+    end
+    local deps = lookup(key)
+    if deps then
+        return key, deps
+    end
+    redis.call('HINCRBY', cache_stats_key, 'misses', 1)
+    misses = misses + 1
+    if fn == 'and' then
+        children = order(children)
+    end
+    local keys, seen = {}, {}
+    deps = {}
+    local function depend(child_deps)
+        for _, dep in ipairs(child_deps) do
+            if not seen[dep] then
+                seen[dep] = true
+                deps[#deps + 1] = dep
+            end
+        end
+    end
+    for i, child in ipairs(children) do
+        local child_key, child_deps = evaluate(child)
+        depend(child_deps)
+        if (fn == 'and' or (fn == 'diff' and i == 1))
+                and redis.call('SCARD', child_key) == 0 then
+            return child_key, deps
+        end
+        keys[#keys + 1] = child_key
+    end
+    if fn == 'and' then
+        store('SINTERSTORE', key, keys)
+    elseif fn == 'or' then
+        store('SUNIONSTORE', key, keys)
+    elseif fn == 'diff' then
+        store('SDIFFSTORE', key, keys)
+    elseif fn == 'not' then
+        depend({universe_deps_key})
+        store('SDIFFSTORE', key, {universe_key, unpack(keys)})
+    else
+        error("Unknown Taxon operator '" .. fn .. "'")
+    end
+    remember(key, deps)
+    return key, deps
+end
+
+local key = evaluate(tree)
+if size > 0 then
+    local excess = redis.call('ZCARD', cache_key) - size
+    if excess > 0 then
+        local victims = redis.call('ZRANGEBYSCORE', cache_key, '-inf', '(' .. clock,
+                                   'LIMIT', 0, excess)
+        for _, victim in ipairs(victims) do
+            drop(victim)
+        end
+        redis.call('HINCRBY', cache_stats_key, 'evictions', #victims)
+    end
+end
+local has_intercard = true
+
+local function intercard(a, b)
+    -- SINTERCARD needs Redis 7; before that, probe the smaller set's members
+    if has_intercard then
+        local n = redis.pcall('SINTERCARD', 2, a, b)
+        if type(n) == 'number' then
+            return n
+        end
+        has_intercard = false
+    end
+    if redis.call('SCARD', a) > redis.call('SCARD', b) then
+        a, b = b, a
+    end
+    local n = 0
+    for _, member in ipairs(redis.call('SMEMBERS', a)) do
+        n = n + redis.call('SISMEMBER', b, member)
+    end
+    return n
+end
+
+if mode == 'facets' then
+    local tag_prefix, item_prefix = ARGV[7], ARGV[8]
+    local counts, facets = {}, {}
+    if #ARGV > 8 then
+        for i = 9, #ARGV do
+            counts[ARGV[i]] = intercard(key, tag_prefix .. ARGV[i])
+        end
+    else
+        for _, item in ipairs(redis.call('SMEMBERS', key)) do
+            for _, tag in ipairs(redis.call('SMEMBERS', item_prefix .. item)) do
+                counts[tag] = (counts[tag] or 0) + 1
+            end
+        end
+    end
+    for tag, n in pairs(counts) do
+        if n > 0 then
+            facets[#facets + 1] = tag
+            facets[#facets + 1] = n
+        end
+    end
+    return {key, facets, hits, misses}
+elseif mode == 'count' then
+    return {key, redis.call('SCARD', key), hits, misses}
+elseif mode == 'scan' then
+    return {key, redis.call('SSCAN', key, ARGV[7], 'COUNT', ARGV[8]), hits, misses}
+end
+return {key, redis.call('SMEMBERS', key), hits, misses}
+"""
+
+# Adds tags to batches of items. ARGV holds, after the key prefixes, each tag
+# followed by the number of its items and then the items themselves. The
+# reply of SADD tells which items are new, so the counters are only bumped
+# for those, once per tag and once per item. Returns the list of newly tagged
+# items of every tag, in order.
+TAG = CACHE + """
+local tags_key, items_key, universe_key = KEYS[4], KEYS[5], KEYS[6]
+local tag_prefix, item_prefix, deps_prefix, universe_deps_key = ARGV[1], ARGV[2], ARGV[3], ARGV[4]
+local result, counts = {}, {}
+local i = 5
+while i <= #ARGV do
+    local tag, n = ARGV[i], tonumber(ARGV[i + 1])
+    local tag_key = tag_prefix .. tag
+    local added = {}
+    for j = i + 2, i + 1 + n do
+        local item = ARGV[j]
+        if redis.call('SADD', tag_key, item) == 1 then
+            redis.call('SADD', item_prefix .. item, tag)
+            counts[item] = (counts[item] or 0) + 1
+            added[#added + 1] = item
+        end
+    end
+    if #added > 0 then
+        redis.call('ZINCRBY', tags_key, #added, tag)
+        invalidate(deps_prefix .. tag)
+    end
+    result[#result + 1] = added
+    i = i + 2 + n
+end
+local born = false
+for item, count in pairs(counts) do
+    if tonumber(redis.call('ZINCRBY', items_key, count, item)) == count then
+        redis.call('SADD', universe_key, item)
+        born = true
+    end
+end
+if born then
+    invalidate(universe_deps_key)
+end
+return result
+"""
+
+# The reverse of TAG, driven by the reply of SREM. Returns the items the tag
+# was removed from.
+UNTAG = CACHE + """
+local tags_key, items_key, universe_key, tag_key = KEYS[4], KEYS[5], KEYS[6], KEYS[7]
+local tag, item_prefix, deps_prefix, universe_deps_key = ARGV[1], ARGV[2], ARGV[3], ARGV[4]
+local removed, died = {}, false
+for i = 5, #ARGV do
+    local item = ARGV[i]
+    if redis.call('SREM', tag_key, item) == 1 then
+        if tonumber(redis.call('ZINCRBY', items_key, -1, item)) <= 0 then
+            redis.call('SREM', universe_key, item)
+            died = true
+        end
+        redis.call('SREM', item_prefix .. item, tag)
+        removed[#removed + 1] = item
+    end
+end
+if #removed > 0 then
+    redis.call('ZINCRBY', tags_key, -#removed, tag)
+    invalidate(deps_prefix .. tag)
+end
+if died then
+    invalidate(universe_deps_key)
+end
+return removed
+"""
+
+# Removes a batch of items, touching only the tags recorded in the reverse
+# index at ``item:<item>``. Returns the items that were in the store, or
+# fails before writing anything if an item is counted but not indexed, as in
+# stores written before the index existed.
+REMOVE = CACHE + """
+local tags_key, items_key, universe_key = KEYS[4], KEYS[5], KEYS[6]
+local tag_prefix, item_prefix, deps_prefix, universe_deps_key = ARGV[1], ARGV[2], ARGV[3], ARGV[4]
+local removed, counts = {}, {}
+for i = 5, #ARGV do
+    local count = redis.call('ZSCORE', items_key, ARGV[i])
+    if count and tonumber(count) > 0 and redis.call('EXISTS', item_prefix .. ARGV[i]) == 0 then
+        return redis.error_reply('item index missing, run RedisBackend.rebuild_indexes()')
+    end
+end
+for i = 5, #ARGV do
+    local item = ARGV[i]
+    local item_key = item_prefix .. item
+    local tags = redis.call('SMEMBERS', item_key)
+    if #tags > 0 then
+        for _, tag in ipairs(tags) do
+            redis.call('SREM', tag_prefix .. tag, item)
+            counts[tag] = (counts[tag] or 0) + 1
+        end
+        redis.call('ZINCRBY', items_key, -#tags, item)
+        redis.call('SREM', universe_key, item)
+        redis.call('DEL', item_key)
+        removed[#removed + 1] = item
+    end
+end
+for tag, count in pairs(counts) do
+    redis.call('ZINCRBY', tags_key, -count, tag)
+    invalidate(deps_prefix .. tag)
+end
+if #removed > 0 then
+    invalidate(universe_deps_key)
+end
+return removed
+"""
@@ -1,10 +1,22 @@
+from itertools import islice
+
+from ..query import Tag
+
+
 class Backend(object):
+    # The ``taxon.stats.Stats`` object measurements are reported to, if any
+    stats = None
+
     def __init__(self):
         pass
 
     def tag_items(self, tag, *items):
         raise NotImplementedError
 
+    def tag_many(self, mapping):
+        return dict((tag, self.tag_items(tag, *items))
+                    for tag, items in mapping.iteritems())
+
     def untag_items(self, tag, *items):
         raise NotImplementedError
 
@@ -17,8 +29,50 @@ class Backend(object):
     def all_items(self):
         raise NotImplementedError
 
+    def top_tags(self, n):
+        raise NotImplementedError
+
+    def top_items(self, n):
+        raise NotImplementedError
+
+    def tag_counts(self, tags):
+        raise NotImplementedError
+
     def query(self, q):
         raise NotImplementedError
 
+    def count(self, q):
+        _, items = self.query(q)
+        return len(items)
+
+    def page(self, q, cursor=0, limit=100):
+        _, items = self.query(q)
+        cursor = int(cursor)
+        items = list(islice(items, cursor, cursor + limit + 1))
+        if len(items) > limit:
+            return cursor + limit, items[:limit]
+        return 0, items
+
+    def iter_query(self, q, batch_size=1000):
+        # The result may be a live set of the backend, which writes change
+        _, items = self.query(q)
+        return iter(list(items))
+
+    def query_many(self, queries, count=False):
+        if count:
+            return [self.count(q) for q in queries]
+        return [self.query(q)[1] for q in queries]
+
+    def facets(self, q, tags=None):
+        _, items = self.query(q)
+        items = set(items)
+        counts = {}
+        for tag in self.all_tags() if tags is None else tags:
+            _, tagged = self.query(Tag(tag))
+            n = len(items.intersection(tagged))
+            if n:
+                counts[tag] = n
+        return counts
+
     def empty(self):
         raise NotImplementedError
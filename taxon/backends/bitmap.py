@@ -0,0 +1,220 @@
+import heapq
+import time
+from binascii import hexlify
+from operator import itemgetter
+
+from .backend import Backend
+from ..query import plan
+
+
+def _bits(ids, size):
+    "Return an integer bitset with the bits in ``ids`` set."
+    buf = bytearray(size // 8 + 1)
+    for i in ids:
+        buf[i >> 3] |= 1 << (i & 7)
+    buf.reverse()
+    return long(hexlify(buf), 16)
+
+
+def _popcount(bits):
+    "Return the number of bits set in the integer bitset ``bits``."
+    return bin(bits).count('1')
+
+
+def _ids(bits):
+    "Return the positions of the bits set in the integer bitset ``bits``."
+    s = bin(bits)[:1:-1]
+    ids = []
+    i = s.find('1')
+    while i != -1:
+        ids.append(i)
+        i = s.find('1', i + 1)
+    return ids
+
+
+class BitmapBackend(Backend):
+    """An in-process backend that stores every tag as an integer bitset.
+
+    Items are mapped to dense integer ids, so ``And``, ``Or`` and ``Not``
+    queries run as word-level operations on the bitsets, and ids are only
+    turned back into items for the final result.
+    """
+
+    def __init__(self):
+        self.empty()
+
+    def _assign(self, item):
+        if self._free:
+            i = self._free.pop()
+            self._items[i] = item
+        else:
+            i = len(self._items)
+            self._items.append(item)
+            self._counts.append(0)
+        self._ids[item] = i
+        return i
+
+    def _release(self, ids):
+        for i in ids:
+            del self._ids[self._items[i]]
+            self._items[i] = None
+        self._free.extend(ids)
+
+    def tag_items(self, tag, *items):
+        ids = [self._ids[item] if item in self._ids else self._assign(item)
+               for item in set(items)]
+        if not ids:
+            return []
+        bits = self.tagged.get(tag, 0)
+        new_bits = _bits(ids, len(self._items)) & ~bits
+        if not new_bits:
+            return []
+        new_ids = _ids(new_bits)
+        self.tagged[tag] = bits | new_bits
+        self.tags[tag] = self.tags.get(tag, 0) + len(new_ids)
+        self.live |= new_bits
+        for i in new_ids:
+            self._counts[i] += 1
+        return [self._items[i] for i in new_ids]
+
+    def untag_items(self, tag, *items):
+        ids = [self._ids[item] for item in set(items) if item in self._ids]
+        bits = self.tagged.get(tag, 0)
+        old_bits = _bits(ids, len(self._items)) & bits
+        if not old_bits:
+            return []
+        old_ids = _ids(old_bits)
+        self.tagged[tag] = bits & ~old_bits
+        self.tags[tag] -= len(old_ids)
+        old_items = [self._items[i] for i in old_ids]
+        dead = []
+        for i in old_ids:
+            self._counts[i] -= 1
+            if self._counts[i] == 0:
+                dead.append(i)
+        if dead:
+            self.live &= ~_bits(dead, len(self._items))
+            self._release(dead)
+        return old_items
+
+    def remove_items(self, *items):
+        ids = [self._ids[item] for item in set(items) if item in self._ids]
+        if not ids:
+            return []
+        mask = _bits(ids, len(self._items))
+        for tag, bits in self.tagged.items():
+            hit = bits & mask
+            if not hit:
+                continue
+            self.tagged[tag] = bits & ~hit
+            self.tags[tag] -= _popcount(hit)
+        removed = [self._items[i] for i in ids]
+        for i in ids:
+            self._counts[i] = 0
+        self.live &= ~mask
+        self._release(ids)
+        return removed
+
+    def all_tags(self):
+        return [tag for tag, count in self.tags.items() if count > 0]
+
+    def all_items(self):
+        return self._decode(self.live)
+
+    def top_tags(self, n):
+        return heapq.nlargest(n, ((tag, count) for tag, count in self.tags.iteritems() if count > 0),
+                              key=itemgetter(1))
+
+    def top_items(self, n):
+        top = heapq.nlargest(n, ((count, i) for i, count in enumerate(self._counts) if count > 0))
+        return [(self._items[i], count) for count, i in top]
+
+    def tag_counts(self, tags):
+        return dict((tag, self.tags.get(tag, 0)) for tag in tags)
+
+    def query(self, q):
+        fn, args = self._plan(q)
+        return None, self._decode(self._raw_query(fn, args))
+
+    def count(self, q):
+        fn, args = self._plan(q)
+        return _popcount(self._raw_query(fn, args))
+
+    def page(self, q, cursor=0, limit=100):
+        fn, args = self._plan(q)
+        ids = _ids(self._raw_query(fn, args))
+        cursor = int(cursor)
+        items = [self._items[i] for i in ids[cursor:cursor + limit]]
+        if cursor + limit < len(ids):
+            return cursor + limit, items
+        return 0, items
+
+    def iter_query(self, q, batch_size=1000):
+        fn, args = self._plan(q)
+        for i in _ids(self._raw_query(fn, args)):
+            yield self._items[i]
+
+    def facets(self, q, tags=None):
+        fn, args = self._plan(q)
+        bits = self._raw_query(fn, args)
+        counts = {}
+        for tag in self.tagged.keys() if tags is None else tags:
+            n = _popcount(bits & self.tagged.get(tag, 0))
+            if n:
+                counts[tag] = n
+        return counts
+
+    def _plan(self, q):
+        return plan(q, self.tags.get, len(self._ids))
+
+    def _raw_query(self, fn, args):
+        if self.stats is not None:
+            start = time.time()
+            result = self._evaluate_node(fn, args)
+            self.stats.node(fn, time.time() - start)
+            return result
+        return self._evaluate_node(fn, args)
+
+    def _evaluate_node(self, fn, args):
+        if fn == 'tag':
+            return self.tagged.get(args[0], 0)
+        elif fn == 'and':
+            result = self._raw_query(*args[0])
+            for a in args[1:]:
+                if not result:
+                    break
+                result &= self._raw_query(*a)
+            return result
+        elif fn == 'or':
+            results = [self._raw_query(*a) for a in args]
+            return reduce(lambda a, b: a | b, results)
+        elif fn == 'not':
+            results = [self._raw_query(*a) for a in args]
+            return reduce(lambda a, b: a & ~b, results, self.live)
+        elif fn == 'diff':
+            result = self._raw_query(*args[0])
+            for a in args[1:]:
+                if not result:
+                    break
+                result &= ~self._raw_query(*a)
+            return result
+        else:
+            raise ValueError
+
+    def _decode(self, bits):
+        return [self._items[i] for i in _ids(bits)]
+
+    def empty(self):
+        self.tagged = dict()
+        self.tags = dict()
+        self.live = 0
+        self._ids = dict()
+        self._items = []
+        self._counts = []
+        self._free = []
+
+    def __str__(self):
+        return unicode(self).encode('utf-8')
+
+    def __unicode__(self):
+        return u"%s()" % (self.__class__.__name__)
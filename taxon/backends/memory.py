@@ -1,95 +1,424 @@
-import operator
+import heapq
+import threading
+import time
+from operator import itemgetter
+
 try:
     from collections import Counter
 except ImportError:
     from ._counter import Counter
 
+try:
+    from collections import OrderedDict
+except ImportError:
+    from ._ordereddict import OrderedDict
+
+from . import _batch
 from .backend import Backend
-from ..query import Query
+from .snapshot import SnapshotBackend, write_snapshot
+from ..query import plan
+
+
+def _tag_facets(items, tagged, tags):
+    "Count the items of each tag that are in ``items`` without copying sets."
+    counts = {}
+    for tag in tags:
+        small, large = items, tagged.get(tag, ())
+        if len(small) > len(large):
+            small, large = large, small
+        n = sum(1 for item in small if item in large)
+        if n:
+            counts[tag] = n
+    return counts
 
 
 class MemoryBackend(Backend):
-    def __init__(self):
+    def __init__(self, cache_size=0):
+        # Results of the last ``cache_size`` distinct query nodes are cached,
+        # each with the generations of the tags it read and of the universe
+        # when it used it; a write bumps the generations of what it changes,
+        # so a cached result is only stale once one of those has moved on
+        self.cache_size = cache_size
         self.empty()
 
     def tag_items(self, tag, *items):
-        if tag not in self.tags:
-            self.tags[tag] = 0
-            self.tagged[tag] = set()
-        new_items = set(items) - self.tagged[tag]
-        if len(new_items) == 0:
-            return []
-        self.tags[tag] += len(new_items)
-        self.tagged[tag].update(set(new_items))
-        self.items += Counter(new_items)
-        return list(new_items)
+        return self.tag_many({tag: items})[tag]
+
+    def tag_many(self, mapping):
+        added = {}
+        for tag, items in mapping.iteritems():
+            tagged = self.tagged.get(tag)
+            if tagged is None:
+                new_items = set(items)
+            else:
+                new_items = set(items) - tagged
+            added[tag] = list(new_items)
+            if len(new_items) == 0:
+                continue
+            if tagged is None:
+                self.tagged[tag] = new_items.copy()
+            else:
+                tagged.update(new_items)
+            self.tags[tag] += len(new_items)
+            self._bump(tag)
+            for item in new_items:
+                self.items[item] += 1
+                if item in self.item_tags:
+                    self.item_tags[item].add(tag)
+                else:
+                    self.item_tags[item] = set([tag])
+                    self.universe.add(item)
+                    self._universe_generation += 1
+        return added
 
     def untag_items(self, tag, *items):
-        old_items = set(items) & self.tagged[tag]
+        tagged = self.tagged.get(tag)
+        if tagged is None:
+            return []
+        old_items = tagged.intersection(items)
         if len(old_items) == 0:
             return []
-        self.tags[tag] -= len(old_items)
-        self.tagged[tag] -= set(old_items)
-        self.items -= Counter(old_items)
+        tagged.difference_update(old_items)
+        self._forget_tag(tag, len(old_items))
+        for item in old_items:
+            self._forget_item(item, tag)
         return list(old_items)
 
     def remove_items(self, *items):
         removed = []
         for item in set(items):
-            if item not in self.items:
+            tags = self.item_tags.get(item)
+            if tags is None:
                 continue
-            for tag in self.all_tags():
-                if item not in self.tagged[tag]:
-                    continue
-                self.tagged[tag] -= set([item])
-                self.tags[tag] -= 1
-                self.items[item] -= 1
+            for tag in list(tags):
+                self.tagged[tag].discard(item)
+                self._forget_tag(tag, 1)
+                self._forget_item(item, tag)
             removed.append(item)
         return removed
 
+    def _forget_tag(self, tag, count):
+        self.tags[tag] -= count
+        self._bump(tag)
+        if self.tags[tag] <= 0:
+            del self.tags[tag]
+            del self.tagged[tag]
+            # Generations come from one clock, so a tag that comes back never
+            # reuses a generation and missing tags can share generation 0
+            del self._generations[tag]
+
+    def _forget_item(self, item, tag):
+        self.items[item] -= 1
+        self.item_tags[item].discard(tag)
+        if self.items[item] <= 0:
+            del self.items[item]
+            del self.item_tags[item]
+            self.universe.discard(item)
+            self._universe_generation += 1
+
+    def _bump(self, tag):
+        self._clock += 1
+        self._generations[tag] = self._clock
+
     def all_tags(self):
-        return [tag[0] for tag in self.tags.items() if tag[1] > 0]
+        return list(self.tags)
 
     def all_items(self):
-        return [item[0] for item in self.items.items() if item[1] > 0]
+        return list(self.universe)
+
+    def top_tags(self, n):
+        return self.tags.most_common(n)
+
+    def top_items(self, n):
+        return self.items.most_common(n)
+
+    def tag_counts(self, tags):
+        return dict((tag, self.tags.get(tag, 0)) for tag in tags)
 
     def query(self, q):
-        if isinstance(q, Query):
-            fn, args = q.freeze()
-            return self._raw_query(fn, args)
-        elif isinstance(q, tuple):
-            fn, args = q
-            return self._raw_query(fn, args)
-        else:
-            raise ValueError
+        fn, args = self._plan(q)
+        return self._raw_query(fn, args)
+
+    def _plan(self, q):
+        return plan(q, self.tags.get, len(self.universe))
 
     def _raw_query(self, fn, args):
+        return None, self._evaluate(fn, args, self.tagged, self.universe)
+
+    def _evaluate(self, fn, args, tagged, universe):
+        if self.cache_size and fn != 'tag':
+            return self._evaluate_cached(fn, args, tagged, universe)
+        return self._evaluate_timed(fn, args, tagged, universe)
+
+    def _evaluate_cached(self, fn, args, tagged, universe):
+        key = (fn, args)
+        entry = self._cache.pop(key, None)
+        if entry is not None:
+            result, generations, universe_generation = entry
+            if (universe_generation in (None, self._universe_generation)
+                    and all(self._generations.get(tag, 0) == generation
+                            for tag, generation in generations)):
+                self._cache[key] = entry
+                self._count_cache('hits')
+                return result
+            self._count_cache('invalidations')
+        self._count_cache('misses')
+        result = frozenset(self._evaluate_timed(fn, args, tagged, universe))
+        tags, uses_universe = self._dependencies(fn, args)
+        generations = tuple((tag, self._generations.get(tag, 0)) for tag in tags)
+        universe_generation = self._universe_generation if uses_universe else None
+        self._cache[key] = (result, generations, universe_generation)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+            self._count_cache('evictions')
+        return result
+
+    def _count_cache(self, counter):
+        self._cache_counts[counter] += 1
+        if self.stats is not None and counter in ('hits', 'misses'):
+            self.stats.incr('cache.' + counter)
+
+    def _dependencies(self, fn, args):
+        "Return the tags a query node reads and whether it reads the universe."
         if fn == 'tag':
-            if len(args) == 1:
-                return None, self.tagged.get(args[0], [])
-            else:
-                groups = [self.tagged.get(tag, []) for tag in args]
-                return None, reduce(operator.add, groups)
+            return set(args), False
+        tags, uses_universe = set(), fn == 'not'
+        for a in args:
+            child_tags, child_universe = self._dependencies(*a)
+            tags.update(child_tags)
+            uses_universe = uses_universe or child_universe
+        return tags, uses_universe
+
+    def cache_stats(self):
+        """Return the hit, miss, eviction and invalidation counts of the
+        query cache, and the number of results it holds."""
+        stats = dict(self._cache_counts)
+        stats['size'] = len(self._cache)
+        return stats
+
+    def _evaluate_timed(self, fn, args, tagged, universe):
+        if self.stats is not None:
+            start = time.time()
+            result = self._evaluate_node(fn, args, tagged, universe)
+            self.stats.node(fn, time.time() - start)
+            return result
+        return self._evaluate_node(fn, args, tagged, universe)
+
+    def _evaluate_node(self, fn, args, tagged, universe):
+        if fn == 'tag':
+            return tagged.get(args[0], set())
         elif fn == 'and':
-            results = [set(items) for _, items in [self._raw_query(*a) for a in args]]
-            return None, reduce(operator.__and__, results)
+            result = self._evaluate(args[0][0], args[0][1], tagged, universe)
+            for a in args[1:]:
+                if not result:
+                    break
+                result = result & self._evaluate(a[0], a[1], tagged, universe)
+            return result
         elif fn == 'or':
-            results = [set(items) for _, items in [self._raw_query(*a) for a in args]]
-            return None, reduce(operator.__or__, results)
+            return set().union(*[self._evaluate(a[0], a[1], tagged, universe) for a in args])
         elif fn == 'not':
-            results = [set(items) for _, items in [self._raw_query(*a) for a in args]]
-            results.insert(0, set(self.all_items()))
-            return None, reduce(operator.sub, results)
+            result = universe
+            for a in args:
+                result = result - self._evaluate(a[0], a[1], tagged, universe)
+            return result
+        elif fn == 'diff':
+            result = set(self._evaluate(args[0][0], args[0][1], tagged, universe))
+            for a in args[1:]:
+                if not result:
+                    break
+                result.difference_update(self._evaluate(a[0], a[1], tagged, universe))
+            return result
         else:
             raise ValueError
 
+    def query_many(self, queries, count=False):
+        if _batch.numpy is None:
+            return super(MemoryBackend, self).query_many(queries, count)
+        return _batch.evaluate_many(queries, self.tagged, self.universe, count)
+
+    def facets(self, q, tags=None):
+        _, items = self.query(q)
+        if tags is not None:
+            return _tag_facets(items, self.tagged, tags)
+        counts = Counter()
+        for item in items:
+            counts.update(self.item_tags[item])
+        return dict(counts)
+
+    def snapshot(self, path, codec=None):
+        """Write the tags and items to a snapshot file at ``path``, with items
+        encoded by ``codec``."""
+        write_snapshot(path, self.tagged, codec)
+
+    @classmethod
+    def open_snapshot(cls, path, codec=None):
+        """Return a read-only ``SnapshotBackend`` querying the snapshot file
+        at ``path`` in place."""
+        return SnapshotBackend(path, codec)
+
     def empty(self):
         self.tagged = dict()
         self.items = Counter()
         self.tags = Counter()
+        self.item_tags = dict()
+        self.universe = set()
+        self._clock = 0
+        self._generations = dict()
+        self._universe_generation = 0
+        self._cache = OrderedDict()
+        self._cache_counts = Counter(hits=0, misses=0, evictions=0, invalidations=0)
 
     def __str__(self):
         return unicode(self).encode('utf-8')
 
     def __unicode__(self):
         return u"%s()" % (self.__class__.__name__)
+
+
+class ConcurrentMemoryBackend(MemoryBackend):
+    """A thread-safe memory backend whose readers never take a lock.
+
+    The tag sets and the universe of items are immutable and published
+    together as one ``(tagged, universe)`` state. Writers are serialized by a
+    lock and publish a new state holding new copies of the sets they change,
+    so a query reads the state once and sees a consistent view of the store
+    however long it runs, without stalling writers or being stalled by them.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        super(ConcurrentMemoryBackend, self).__init__()
+
+    @property
+    def tagged(self):
+        return self._state[0]
+
+    @property
+    def universe(self):
+        return self._state[1]
+
+    def tag_many(self, mapping):
+        added = {}
+        with self._lock:
+            tagged, universe = self._state
+            tagged = dict(tagged)
+            new_items = set()
+            for tag, items in mapping.iteritems():
+                current = tagged.get(tag, frozenset())
+                items = set(items) - current
+                added[tag] = list(items)
+                if not items:
+                    continue
+                tagged[tag] = current | items
+                for item in items:
+                    tags = self.item_tags.get(item)
+                    if tags is None:
+                        self.item_tags[item] = set([tag])
+                        new_items.add(item)
+                    else:
+                        tags.add(tag)
+            if new_items:
+                universe = universe | new_items
+            self._state = (tagged, universe)
+        return added
+
+    def untag_items(self, tag, *items):
+        with self._lock:
+            tagged, universe = self._state
+            current = tagged.get(tag)
+            if current is None:
+                return []
+            old_items = current.intersection(items)
+            if not old_items:
+                return []
+            tagged = dict(tagged)
+            self._replace(tagged, tag, current - old_items)
+            forgotten = []
+            for item in old_items:
+                tags = self.item_tags[item]
+                tags.discard(tag)
+                if not tags:
+                    del self.item_tags[item]
+                    forgotten.append(item)
+            if forgotten:
+                universe = universe.difference(forgotten)
+            self._state = (tagged, universe)
+        return list(old_items)
+
+    def remove_items(self, *items):
+        with self._lock:
+            tagged, universe = self._state
+            removed, changed = [], {}
+            for item in set(items):
+                tags = self.item_tags.pop(item, None)
+                if tags is None:
+                    continue
+                for tag in tags:
+                    changed.setdefault(tag, []).append(item)
+                removed.append(item)
+            if not removed:
+                return []
+            tagged = dict(tagged)
+            for tag, old_items in changed.iteritems():
+                self._replace(tagged, tag, tagged[tag].difference(old_items))
+            self._state = (tagged, universe.difference(removed))
+        return removed
+
+    def _replace(self, tagged, tag, items):
+        if items:
+            tagged[tag] = items
+        else:
+            del tagged[tag]
+
+    def all_tags(self):
+        return list(self._state[0])
+
+    def all_items(self):
+        return list(self._state[1])
+
+    def top_tags(self, n):
+        tagged = self._state[0]
+        return heapq.nlargest(n, ((tag, len(items)) for tag, items in tagged.iteritems()),
+                              key=itemgetter(1))
+
+    def top_items(self, n):
+        # The reverse index is only consistent under the writers' lock, so
+        # count the tags of each item from the published tag sets instead
+        counts = Counter()
+        for items in self._state[0].itervalues():
+            counts.update(items)
+        return heapq.nlargest(n, counts.iteritems(), key=itemgetter(1))
+
+    def tag_counts(self, tags):
+        tagged = self._state[0]
+        return dict((tag, len(tagged.get(tag, ()))) for tag in tags)
+
+    def query(self, q):
+        tagged, universe = self._state
+        fn, args = plan(q, lambda tag: len(tagged.get(tag, ())), len(universe))
+        return None, self._evaluate(fn, args, tagged, universe)
+
+    def _raw_query(self, fn, args):
+        tagged, universe = self._state
+        return None, self._evaluate(fn, args, tagged, universe)
+
+    def query_many(self, queries, count=False):
+        if _batch.numpy is None:
+            return super(ConcurrentMemoryBackend, self).query_many(queries, count)
+        tagged, universe = self._state
+        return _batch.evaluate_many(queries, tagged, universe, count)
+
+    def facets(self, q, tags=None):
+        tagged, universe = self._state
+        fn, args = plan(q, lambda tag: len(tagged.get(tag, ())), len(universe))
+        items = self._evaluate(fn, args, tagged, universe)
+        return _tag_facets(items, tagged, list(tagged) if tags is None else tags)
+
+    def cache_stats(self):
+        "Results are never cached, so every count is zero."
+        return {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0, 'size': 0}
+
+    def empty(self):
+        with self._lock:
+            self.item_tags = dict()
+            self._state = (dict(), frozenset())
@@ -0,0 +1,172 @@
+import heapq
+import multiprocessing
+from itertools import chain
+from operator import itemgetter
+
+try:
+    from collections import Counter
+except ImportError:
+    from ._counter import Counter
+
+from .backend import Backend
+from .memory import MemoryBackend
+from ..query import plan
+
+# The shards a pool worker evaluates queries on, set when it starts. Workers
+# are forked, so they inherit the shards as they were when the pool was
+# started and share their memory with the parent until either side writes.
+_shards = None
+
+
+def _init(shards):
+    global _shards
+    _shards = shards
+
+
+def _evaluate(task, shards=None):
+    index, fn, args, mode = task
+    if shards is None:
+        shards = _shards
+    _, items = shards[index]._raw_query(fn, args)
+    if mode == 'count':
+        return len(items)
+    return list(items)
+
+
+class ParallelMemoryBackend(Backend):
+    """A memory backend that evaluates queries on a pool of processes.
+
+    Items are partitioned over ``workers`` in-memory shards by their hash, so
+    an item and all of its tags live in one shard. Queries on stores of at
+    least ``min_items`` items are planned once, evaluated on every shard by a
+    pool of forked worker processes, and the results are concatenated;
+    smaller stores are queried in-process, where the round trips to the pool
+    would cost more than they save.
+
+    Workers see the store as it was when they were forked, so the first large
+    query after a write restarts the pool. This suits large, read-mostly
+    indexes, and requires a platform where ``multiprocessing`` forks.
+    """
+
+    def __init__(self, workers=None, min_items=100000):
+        self.workers = workers or multiprocessing.cpu_count()
+        self.min_items = min_items
+        self._pool = None
+        self.empty()
+
+    def _shard(self, item):
+        return self._shards[hash(item) % self.workers]
+
+    def _changed(self):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool = None
+
+    def tag_items(self, tag, *items):
+        return self.tag_many({tag: items})[tag]
+
+    def tag_many(self, mapping):
+        per_shard = {}
+        for tag, items in mapping.iteritems():
+            for item in items:
+                per_shard.setdefault(self._shard(item), {}).setdefault(tag, []).append(item)
+        added = dict((tag, []) for tag in mapping)
+        for shard, shard_mapping in per_shard.iteritems():
+            for tag, items in shard.tag_many(shard_mapping).iteritems():
+                added[tag].extend(items)
+        self._changed()
+        return added
+
+    def untag_items(self, tag, *items):
+        per_shard = {}
+        for item in items:
+            per_shard.setdefault(self._shard(item), []).append(item)
+        removed = []
+        for shard, shard_items in per_shard.iteritems():
+            removed.extend(shard.untag_items(tag, *shard_items))
+        self._changed()
+        return removed
+
+    def remove_items(self, *items):
+        per_shard = {}
+        for item in items:
+            per_shard.setdefault(self._shard(item), []).append(item)
+        removed = []
+        for shard, shard_items in per_shard.iteritems():
+            removed.extend(shard.remove_items(*shard_items))
+        self._changed()
+        return removed
+
+    def all_tags(self):
+        tags = set()
+        for shard in self._shards:
+            tags.update(shard.tags)
+        return list(tags)
+
+    def all_items(self):
+        return list(chain(*[shard.universe for shard in self._shards]))
+
+    def top_tags(self, n):
+        totals = Counter()
+        for shard in self._shards:
+            totals.update(shard.tags)
+        return totals.most_common(n)
+
+    def top_items(self, n):
+        tops = [shard.top_items(n) for shard in self._shards]
+        return heapq.nlargest(n, chain(*tops), key=itemgetter(1))
+
+    def tag_counts(self, tags):
+        return dict((tag, sum(shard.tags.get(tag, 0) for shard in self._shards))
+                    for tag in tags)
+
+    def query_many(self, queries, count=False):
+        queries = list(queries)
+        results = [shard.query_many(queries, count) for shard in self._shards]
+        if count:
+            return map(sum, zip(*results))
+        return [list(chain(*items)) for items in zip(*results)]
+
+    def facets(self, q, tags=None):
+        totals = Counter()
+        for shard in self._shards:
+            totals.update(shard.facets(q, tags))
+        return dict(totals)
+
+    def _plan(self, q):
+        universe = sum(len(shard.universe) for shard in self._shards)
+        cardinality = lambda tag: sum(shard.tags.get(tag, 0) for shard in self._shards)
+        return plan(q, cardinality, universe), universe
+
+    def _run(self, q, mode):
+        (fn, args), universe = self._plan(q)
+        tasks = [(i, fn, args, mode) for i in xrange(self.workers)]
+        if universe < self.min_items:
+            return [_evaluate(task, self._shards) for task in tasks]
+        if self._pool is None:
+            self._pool = multiprocessing.Pool(self.workers, _init, (self._shards,))
+        return self._pool.map(_evaluate, tasks)
+
+    def query(self, q):
+        return None, list(chain(*self._run(q, 'members')))
+
+    def count(self, q):
+        return sum(self._run(q, 'count'))
+
+    def close(self):
+        "Stop the worker processes."
+        self._changed()
+
+    def __del__(self):
+        if getattr(self, '_pool', None) is not None:
+            self.close()
+
+    def empty(self):
+        self._shards = [MemoryBackend() for _ in xrange(self.workers)]
+        self._changed()
+
+    def __str__(self):
+        return unicode(self).encode('utf-8')
+
+    def __unicode__(self):
+        return u"%s(%r)" % (self.__class__.__name__, self.workers)
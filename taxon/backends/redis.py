@@ -1,26 +1,55 @@
+from __future__ import absolute_import
+
 import hashlib
-try:
-    import cPickle as pickle
-except:
-    import pickle
+import json
+import random
+from binascii import hexlify
 
 from functools import partial
 from itertools import imap
 
+from . import _scripts
 from .backend import Backend
-from ..query import Query
+from ..codec import get_codec
+from ..query import PreparedQuery, canonical
+
+
+def _bytes(s):
+    return s.encode('utf-8') if isinstance(s, unicode) else s
+
+
+def _glob_escape(s):
+    "Escape the characters of ``s`` that are special in Redis glob patterns."
+    return ''.join('\\' + c if c in '*?[]\\' else c for c in s)
 
 
 class RedisBackend(Backend):
-    def __init__(self, redis, name):
+    def __init__(self, redis, name, codec=None, cache_ttl=None, cache_size=10000,
+                 replicas=None):
         self._r = redis
         self._name = name
-        make_key = partial(lambda *parts: ':'.join(parts), self._name)
+        self._replicas = list(replicas or [])
+        self.codec = get_codec(codec)
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+        make_key = partial(lambda *parts: ':'.join(imap(_bytes, parts)), self._name)
         self.tag_key = partial(make_key, 'tag')
+        self.item_key = partial(make_key, 'item')
         self.result_key = partial(make_key, 'result')
         self.items_key = make_key('items')
         self.tags_key = make_key('tags')
-        self.cache_key = make_key('cache')
+        self.universe_key = make_key('universe')
+        # Before results were tracked, ``cache`` was a plain set of them
+        self.cache_key = make_key('cache', 'lru')
+        self.legacy_cache_key = make_key('cache')
+        self.cache_deps_key = make_key('cache', 'deps')
+        self.cache_stats_key = make_key('cache', 'stats')
+        self.deps_key = partial(make_key, 'deps')
+        self.universe_deps_key = make_key('universe', 'deps')
+        self._query_script = self._r.register_script(_scripts.QUERY)
+        self._tag_script = self._r.register_script(_scripts.TAG)
+        self._untag_script = self._r.register_script(_scripts.UNTAG)
+        self._remove_script = self._r.register_script(_scripts.REMOVE)
 
     @property
     def redis(self):
@@ -30,117 +59,271 @@ class RedisBackend(Backend):
     def name(self):
         return self._name
 
+    @property
+    def replicas(self):
+        return self._replicas
+
+    def _reader(self):
+        "Return the client to send a read to: a random replica, if any."
+        if self._replicas:
+            return random.choice(self._replicas)
+        return self._r
+
     def encode(self, data):
-        return pickle.dumps(data)
+        return self.codec.encode(data)
 
     def decode(self, data):
-        return pickle.loads(data)
+        return self.codec.decode(data)
+
+    def decode_many(self, data):
+        return self.codec.decode_many(data)
+
+    def _count(self, commands=1):
+        "Report a round trip of ``commands`` commands to the stats object."
+        if self.stats is not None:
+            self.stats.incr('redis.round_trips')
+            self.stats.incr('redis.commands', commands)
+
+    def _script(self, script, keys, args):
+        "Run one of the Lua scripts, which all start with the cache keys."
+        cache_keys = [self.cache_key, self.cache_deps_key, self.cache_stats_key]
+        self._count()
+        return script(keys=cache_keys + keys, args=args)
 
     def tag_items(self, tag, *items):
-        items = list(set(self.encode(item) for item in items) - self._r.smembers(self.tag_key(tag)))
-        if len(items) == 0:
-            return []
-        with self._r.pipeline() as pipe:
-            pipe.zincrby(self.tags_key, tag, len(items))
-            pipe.sadd(self.tag_key(tag), *items)
-            for item in items:
-                pipe.zincrby(self.items_key, item, 1)
-            pipe.execute()
-        return map(self.decode, items)
+        return self.tag_many({tag: items})[tag]
+
+    def tag_many(self, mapping):
+        tags, args = [], []
+        for tag, items in mapping.iteritems():
+            items = set(imap(self.encode, items))
+            tags.append(tag)
+            args.extend([tag, len(items)])
+            args.extend(items)
+        if not tags:
+            return {}
+        added = self._script(self._tag_script,
+            [self.tags_key, self.items_key, self.universe_key],
+            [self.tag_key(''), self.item_key(''), self.deps_key(''), self.universe_deps_key] + args)
+        return dict((tag, self.decode_many(items)) for tag, items in zip(tags, added))
 
     def untag_items(self, tag, *items):
-        items = list(set(self.encode(item) for item in items) & self._r.smembers(self.tag_key(tag)))
-        if len(items) == 0:
+        items = list(set(imap(self.encode, items)))
+        if not len(items):
             return []
-        with self._r.pipeline() as pipe:
-            pipe.zincrby(self.tags_key, tag, -len(items))
-            pipe.srem(self.tag_key(tag), *items)
-            for item in items:
-                pipe.zincrby(self.items_key, item, -1)
-            pipe.execute()
-        self._clear_cache()
-        return map(self.decode, items)
+        removed = self._script(self._untag_script,
+            [self.tags_key, self.items_key, self.universe_key, self.tag_key(tag)],
+            [tag, self.item_key(''), self.deps_key(''), self.universe_deps_key] + items)
+        return self.decode_many(removed)
 
     def remove_items(self, *items):
-        removed = []
+        items = list(set(imap(self.encode, items)))
         if not len(items):
-            return removed
-        for item in imap(self.encode, items):
-            score = self._r.zscore(self.items_key, item)
-            if not score:
-                continue
-            for tag in self.all_tags():
-                srem_ok = self._r.srem(self.tag_key(tag), item)
-                if not srem_ok:
-                    continue
-                with self._r.pipeline() as pipe:
-                    pipe.zincrby(self.tags_key, tag, -1)
-                    pipe.zincrby(self.items_key, item, -1)
-                    pipe.execute()
-            removed.append(self.decode(item))
-        self._clear_cache()
-        return removed
+            return []
+        removed = self._script(self._remove_script,
+            [self.tags_key, self.items_key, self.universe_key],
+            [self.tag_key(''), self.item_key(''), self.deps_key(''), self.universe_deps_key] + items)
+        return self.decode_many(removed)
 
     def all_tags(self):
-        return list(self._r.zrangebyscore(self.tags_key, 1, '+inf'))
+        self._count()
+        return list(self._reader().zrangebyscore(self.tags_key, 1, '+inf'))
 
     def all_items(self):
-        return map(self.decode, self._r.zrangebyscore(self.items_key, 1, '+inf'))
+        self._count()
+        return self.decode_many(self._reader().zrangebyscore(self.items_key, 1, '+inf'))
+
+    def top_tags(self, n):
+        self._count()
+        top = self._reader().zrevrangebyscore(self.tags_key, '+inf', 1, start=0, num=n,
+                                              withscores=True, score_cast_func=int)
+        return list(top)
+
+    def top_items(self, n):
+        self._count()
+        top = self._reader().zrevrangebyscore(self.items_key, '+inf', 1, start=0, num=n,
+                                              withscores=True, score_cast_func=int)
+        return zip(self.decode_many([item for item, _ in top]), [count for _, count in top])
+
+    def tag_counts(self, tags):
+        tags = list(tags)
+        if not tags:
+            return {}
+        from redis.exceptions import ResponseError
+        reader = self._reader()
+        try:
+            self._count()
+            counts = reader.execute_command('ZMSCORE', self.tags_key, *tags)
+        except ResponseError:
+            # ZMSCORE needs Redis 6.2, so older servers get one pipeline
+            self._count(len(tags))
+            with reader.pipeline(transaction=False) as pipe:
+                for tag in tags:
+                    pipe.zscore(self.tags_key, tag)
+                counts = pipe.execute()
+        return dict((tag, int(float(count or 0))) for tag, count in zip(tags, counts))
 
     def query(self, q):
-        if isinstance(q, Query):
-            fn, args = q.freeze()
-            return self._raw_query(fn, args)
-        elif isinstance(q, tuple):
-            fn, args = q
-            return self._raw_query(fn, args)
-        else:
-            raise TypeError("%s is not a recognized Taxon query" % q)
-
-    def _raw_query(self, fn, args):
+        return self._run(self._compile(q))
+
+    def _plan(self, q):
+        # Plans do not depend on the data, so equivalent queries are
+        # canonicalized to share their cached results; the query script
+        # orders the tags of every intersection by their size instead
+        return canonical(q)
+
+    def _compile(self, q):
+        """Return the root node type, result key and query script argument
+        of the query, stored in the query if it is prepared."""
+        if not isinstance(q, PreparedQuery):
+            return self._compile_plan(self._plan(q))
+        key = ('redis', self._name)
+        compiled = q.compiled.get(key)
+        if compiled is None:
+            compiled = q.compiled[key] = self._compile_plan(q.freeze())
+        return compiled
+
+    def _compile_plan(self, node):
+        tree, keyname = self._tree(node)
+        return tree[0], keyname, json.dumps(tree)
+
+    def _raw_query(self, fn, args, mode='members', *mode_args):
         "Perform a raw query on the Taxon instance"
-        h = hashlib.sha1(pickle.dumps((fn, args)))
-        keyname = self.result_key(h.hexdigest())
-        if self._r.exists(keyname):
-            return (keyname, map(self.decode, self._r.smembers(keyname)))
+        return self._run(self._compile_plan((fn, args)), mode, *mode_args)
 
-        if fn == 'tag':
-            if len(args) == 1:
-                key = self.tag_key(args[0])
-                return (key, map(self.decode, self._r.smembers(key)))
+    def _run(self, compiled, mode='members', *mode_args):
+        "Run a compiled query in the query script."
+        fn, keyname, tree = compiled
+        result = None
+        # SSCAN cursors are only meaningful on the server that issued them,
+        # so scans run on the primary
+        if self._replicas and mode not in ('scan', 'facets'):
+            result = self._replica_query(fn, keyname, mode, *mode_args)
+        if result is None:
+            result = self._script(self._query_script,
+                [self.universe_key],
+                [self.deps_key(''), self.universe_deps_key,
+                 self.cache_ttl or 0, self.cache_size or 0,
+                 tree, mode] + list(mode_args))
+            if self.stats is not None:
+                self.stats.incr('cache.hits', result[2])
+                self.stats.incr('cache.misses', result[3])
+        keyname, result = result[:2]
+        if mode == 'members':
+            return (keyname, self.decode_many(result))
+        return (keyname, result)
+
+    def _replica_query(self, fn, keyname, mode, *mode_args):
+        """Answer a query from a replica when the result is a tag or is
+        already cached, or return ``None`` so the primary evaluates it.
+
+        Replicas are read-only, so results they serve do not count as cache
+        hits and do not refresh their place in the LRU order."""
+        with self._reader().pipeline(transaction=False) as pipe:
+            pipe.exists(keyname)
+            if mode == 'count':
+                pipe.scard(keyname)
             else:
-                keys = [self.tag_key(k) for k in args]
-                self._r.sunionstore(keyname, *keys)
-                self._r.sadd(self.cache_key, keyname)
-                return (keyname, map(self.decode, self._r.smembers(keyname)))
-        elif fn == 'and':
-            interkeys = [key for key, _ in [self._raw_query(*a) for a in args]]
-            self._r.sinterstore(keyname, *interkeys)
-            self._r.sadd(self.cache_key, keyname)
-            return (keyname, map(self.decode, self._r.smembers(keyname)))
-        elif fn == 'or':
-            interkeys = [key for key, _ in [self._raw_query(*a) for a in args]]
-            self._r.sunionstore(keyname, *interkeys)
-            self._r.sadd(self.cache_key, keyname)
-            return (keyname, map(self.decode, self._r.smembers(keyname)))
-        elif fn == 'not':
-            interkeys = [key for key, _ in [self._raw_query(*a) for a in args]]
-            tags = self.all_tags()
-            scratchpad_key = self.result_key('_')
-            self._r.sunionstore(scratchpad_key, *map(self.tag_key, tags))
-            self._r.sdiffstore(keyname, scratchpad_key, *interkeys)
-            self._r.sadd(self.cache_key, keyname)
-            return (keyname, map(self.decode, self._r.smembers(keyname)))
-        else:
-            raise ValueError("Unkown Taxon operator '%s'" % fn)
-
-    def _clear_cache(self):
-        cached_keys = self._r.smembers(self.cache_key)
-        if len(cached_keys) > 0:
-            self._r.delete(*cached_keys)
-        return True
+                pipe.smembers(keyname)
+            self._count(2)
+            exists, result = pipe.execute()
+        if not exists and fn != 'tag':
+            return None
+        return keyname, result
+
+    def count(self, q):
+        _, count = self._run(self._compile(q), 'count')
+        return count
+
+    def page(self, q, cursor=0, limit=100):
+        _, (cursor, members) = self._run(self._compile(q), 'scan', cursor, limit)
+        return int(cursor), self.decode_many(members)
+
+    def iter_query(self, q, batch_size=1000):
+        compiled = self._compile(q)
+        cursor = 0
+        while True:
+            _, (cursor, members) = self._run(compiled, 'scan', cursor, batch_size)
+            for item in self.decode_many(members):
+                yield item
+            if int(cursor) == 0:
+                break
+
+    def facets(self, q, tags=None):
+        if tags is not None:
+            tags = list(tags)
+            if not tags:
+                return {}
+        _, facets = self._run(self._compile(q), 'facets', self.tag_key(''), self.item_key(''),
+                              *(tags or []))
+        return dict(zip(facets[::2], facets[1::2]))
+
+    def _tree(self, node):
+        """Return the query node as nested lists for the query script, with
+        the result key of every node precomputed, and its result key.
+
+        Tags may be any bytes, so tag nodes carry their key and tag hex
+        encoded, and result keys hash the length-prefixed keys of the
+        children so that no tag can make two queries hash alike."""
+        fn, args = node
+        if fn == 'tag':
+            tag = _bytes(args[0])
+            key = self.tag_key(tag)
+            return [fn, hexlify(key), hexlify(tag)], key
+        children = [self._tree(a) for a in args]
+        h = hashlib.sha1(fn)
+        for _, key in children:
+            h.update('%d:%s' % (len(key), key))
+        key = self.result_key(h.hexdigest())
+        return [fn, key, [c for c, _ in children]], key
+
+    def cache_stats(self):
+        """Return the hit, miss, eviction and invalidation counts of the
+        query cache, and the number of results it holds."""
+        with self._r.pipeline(transaction=False) as pipe:
+            pipe.hgetall(self.cache_stats_key)
+            pipe.zcard(self.cache_key)
+            counts, size = pipe.execute()
+        stats = dict((k, int(counts.get(k, 0)))
+                     for k in ('hits', 'misses', 'evictions', 'invalidations'))
+        stats['size'] = size
+        return stats
+
+    def rebuild_indexes(self, batch_size=1000):
+        """Rebuild the reverse index of every item and the universe of items
+        from the tag sets, and drop every cached result, along with the
+        cache set of older versions.
+
+        Stores written by versions of Taxon without these indexes must be
+        rebuilt once: until then removing their items raises an error and
+        queries with ``Not`` miss their items. No writes may run meanwhile.
+        """
+        r = self._r
+        for prefix in [self.item_key(''), self.result_key(''), self.deps_key('')]:
+            keys = list(r.scan_iter(_glob_escape(prefix) + '*', count=batch_size))
+            for i in xrange(0, len(keys), batch_size):
+                r.delete(*keys[i:i + batch_size])
+        r.delete(self.universe_key, self.universe_deps_key, self.cache_key,
+                 self.cache_deps_key, self.cache_stats_key, self.legacy_cache_key)
+        for tag in self.all_tags():
+            items = []
+            for item in r.sscan_iter(self.tag_key(tag), count=batch_size):
+                items.append(item)
+                if len(items) == batch_size:
+                    self._index(tag, items)
+                    items = []
+            if items:
+                self._index(tag, items)
+
+    def _index(self, tag, items):
+        with self._r.pipeline(transaction=False) as pipe:
+            for item in items:
+                pipe.sadd(self.item_key(item), tag)
+            pipe.sadd(self.universe_key, *items)
+            pipe.execute()
 
     def empty(self):
+        self._count()
         self._r.flushdb()
 
     def __str__(self):
@@ -0,0 +1,250 @@
+import bisect
+import hashlib
+import heapq
+from itertools import chain
+from operator import itemgetter
+from multiprocessing.pool import ThreadPool
+
+from .backend import Backend
+from .redis import RedisBackend
+
+
+class ShardedRedisBackend(Backend):
+    """A backend that spreads items over several Redis nodes.
+
+    Items are placed on a consistent hash ring, so each item lives on exactly
+    one shard together with all of its tags. Every query can then be
+    evaluated by every shard on its own items, in parallel, and the partial
+    results are disjoint and simply concatenated. Adding a shard with
+    ``add_shard`` only moves the items that the new shard takes over.
+    """
+
+    points_per_shard = 64
+
+    def __init__(self, redises, name, **options):
+        self._name = name
+        self._options = options
+        self._stats = None
+        self._shards = []
+        self._ring = []
+        for r in redises:
+            self._add_to_ring(RedisBackend(r, name, **options))
+        self._pool = ThreadPool(len(self._shards))
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def shards(self):
+        return list(self._shards)
+
+    @property
+    def stats(self):
+        return self._stats
+
+    @stats.setter
+    def stats(self, stats):
+        self._stats = stats
+        for shard in self._shards:
+            shard.stats = stats
+
+    def _add_to_ring(self, shard):
+        index = len(self._shards)
+        shard.stats = self._stats
+        self._shards.append(shard)
+        for point in xrange(self.points_per_shard):
+            h = self._hash('%d:%d' % (index, point))
+            bisect.insort(self._ring, (h, index))
+
+    def _hash(self, data):
+        return int(hashlib.md5(data).hexdigest()[:16], 16)
+
+    def _shard_index(self, encoded):
+        i = bisect.bisect(self._ring, (self._hash(encoded), len(self._shards)))
+        return self._ring[i % len(self._ring)][1]
+
+    def _group(self, items):
+        "Return the items grouped by the index of the shard they live on."
+        codec = self._shards[0].codec
+        groups = {}
+        for item in items:
+            groups.setdefault(self._shard_index(codec.encode(item)), []).append(item)
+        return groups
+
+    def _map(self, fn, indexes=None):
+        """Call ``fn`` with the shards at ``indexes``, or every shard, and
+        their index in parallel and return the results."""
+        if indexes is None:
+            indexes = range(len(self._shards))
+        stats = self._stats
+        if stats is None:
+            return self._pool.map(lambda i: fn(self._shards[i], i), list(indexes))
+        # Counters the shards increment on the pool's threads belong to the
+        # operations running on this one
+        frames = stats.frames()
+
+        def call(i):
+            with stats.attach(frames):
+                return fn(self._shards[i], i)
+        return self._pool.map(call, list(indexes))
+
+    def tag_items(self, tag, *items):
+        return self.tag_many({tag: items})[tag]
+
+    def tag_many(self, mapping):
+        per_shard = {}
+        for tag, items in mapping.iteritems():
+            for index, group in self._group(items).iteritems():
+                per_shard.setdefault(index, {})[tag] = group
+        added = dict((tag, []) for tag in mapping)
+        results = self._map(lambda shard, i: shard.tag_many(per_shard[i]), per_shard)
+        for result in results:
+            for tag, items in result.iteritems():
+                added[tag].extend(items)
+        return added
+
+    def untag_items(self, tag, *items):
+        groups = self._group(items)
+        results = self._map(lambda shard, i: shard.untag_items(tag, *groups[i]), groups)
+        return list(chain(*results))
+
+    def remove_items(self, *items):
+        groups = self._group(items)
+        results = self._map(lambda shard, i: shard.remove_items(*groups[i]), groups)
+        return list(chain(*results))
+
+    def all_tags(self):
+        tags = set()
+        for shard_tags in self._map(lambda shard, i: shard.all_tags()):
+            tags.update(shard_tags)
+        return list(tags)
+
+    def all_items(self):
+        return list(chain(*self._map(lambda shard, i: shard.all_items())))
+
+    def top_tags(self, n):
+        # A tag's count is spread over the shards. A tag missing from the top
+        # k of every shard counts at most the sum of their k-th counts, so k
+        # grows until the n-th best candidate reaches that bound.
+        if n <= 0:
+            return []
+        k = n
+        while True:
+            tops = self._map(lambda shard, i: shard.top_tags(k))
+            bound = sum(top[-1][1] for top in tops if len(top) == k)
+            candidates = set(tag for top in tops for tag, _ in top)
+            counts = self.tag_counts(candidates)
+            ranked = heapq.nlargest(n, counts.iteritems(), key=itemgetter(1))
+            if bound == 0 or (len(ranked) == n and ranked[-1][1] >= bound):
+                return ranked
+            k *= 2
+
+    def top_items(self, n):
+        tops = self._map(lambda shard, i: shard.top_items(n))
+        return heapq.nlargest(n, chain(*tops), key=itemgetter(1))
+
+    def tag_counts(self, tags):
+        tags = list(tags)
+        totals = dict((tag, 0) for tag in tags)
+        for counts in self._map(lambda shard, i: shard.tag_counts(tags)):
+            for tag, count in counts.iteritems():
+                totals[tag] += count
+        return totals
+
+    def facets(self, q, tags=None):
+        totals = {}
+        for counts in self._map(lambda shard, i: shard.facets(q, tags)):
+            for tag, count in counts.iteritems():
+                totals[tag] = totals.get(tag, 0) + count
+        return totals
+
+    def query(self, q):
+        # Every shard has the same key names, so the query is compiled once
+        compiled = self._shards[0]._compile(q)
+        results = self._map(lambda shard, i: shard._run(compiled))
+        keys = [key for key, _ in results]
+        return keys, list(chain(*[items for _, items in results]))
+
+    def count(self, q):
+        compiled = self._shards[0]._compile(q)
+        return sum(self._map(lambda shard, i: shard._run(compiled, 'count')[1]))
+
+    def page(self, q, cursor=0, limit=100):
+        # The cursor packs the index of the shard being scanned together
+        # with the SSCAN cursor of that shard
+        cursor = int(cursor)
+        n = len(self._shards)
+        index, shard_cursor = cursor % n, cursor // n
+        shard_cursor, items = self._shards[index].page(q, shard_cursor, limit)
+        if shard_cursor:
+            return shard_cursor * n + index, items
+        return (index + 1) % n, items
+
+    def iter_query(self, q, batch_size=1000):
+        return chain(*[shard.iter_query(q, batch_size) for shard in self._shards])
+
+    def add_shard(self, redis):
+        """Add a Redis node to the ring and move over the items it takes
+        over from the existing shards.
+
+        Items are moved in batches, each written to the new shard before it
+        is removed from the old one, so queries may briefly return a moving
+        item twice. Writes to moving items should be avoided meanwhile."""
+        old_shards = list(self._shards)
+        new_index = len(self._shards)
+        self._add_to_ring(RedisBackend(redis, self._name, **self._options))
+        old_pool, self._pool = self._pool, ThreadPool(len(self._shards))
+        old_pool.close()
+        old_pool.join()
+        new_shard = self._shards[new_index]
+        moved = 0
+        for shard in old_shards:
+            batch = []
+            for encoded in shard.redis.sscan_iter(shard.universe_key, count=1000):
+                if self._shard_index(encoded) == new_index:
+                    batch.append(encoded)
+                if len(batch) >= 1000:
+                    moved += self._move(shard, new_shard, batch)
+                    batch = []
+            if batch:
+                moved += self._move(shard, new_shard, batch)
+        return moved
+
+    def _move(self, source, target, encoded_items):
+        with source.redis.pipeline(transaction=False) as pipe:
+            for encoded in encoded_items:
+                pipe.smembers(source.item_key(encoded))
+            tag_sets = pipe.execute()
+        items = source.decode_many(encoded_items)
+        mapping = {}
+        for item, tags in zip(items, tag_sets):
+            for tag in tags:
+                mapping.setdefault(tag, []).append(item)
+        target.tag_many(mapping)
+        return len(source.remove_items(*items))
+
+    def rebuild_indexes(self, batch_size=1000):
+        "Rebuild the indexes of every shard, see ``RedisBackend.rebuild_indexes``."
+        self._map(lambda shard, i: shard.rebuild_indexes(batch_size))
+
+    def close(self):
+        "Stop the threads that call the shards."
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def __del__(self):
+        if getattr(self, '_pool', None) is not None:
+            self.close()
+
+    def empty(self):
+        self._map(lambda shard, i: shard.empty())
+
+    def __str__(self):
+        return unicode(self).encode('utf-8')
+
+    def __unicode__(self):
+        return u"%s(%r, %r)" % (self.__class__.__name__,
+                                [shard.redis for shard in self._shards], self.name)
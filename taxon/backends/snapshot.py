@@ -0,0 +1,262 @@
+"""A compact, read-only file format for the contents of a ``MemoryBackend``.
+
+A snapshot holds an interned table of the encoded items, numbered from 0, the
+sorted list of tags, and for every tag the sorted array of the ids of its
+items. Every table is indexed by an array of file offsets, so a snapshot is
+queried in place through a read-only memory map: opening it reads only the
+header, a query reads only the arrays of the tags it touches, and only the
+items in a result are decoded. Processes that map the same file share one
+copy of it in the page cache.
+
+All integers are little-endian. The layout is a header, then the item data,
+the tag names and the id arrays (unsigned 32-bit), followed by the three
+offset indexes (unsigned 64-bit, one more entry than rows) the header points
+to.
+"""
+import heapq
+import mmap
+import os
+import struct
+import sys
+from array import array
+from itertools import imap
+from operator import itemgetter
+
+try:
+    from collections import Counter
+except ImportError:
+    from ._counter import Counter
+
+from .backend import Backend
+from ..codec import get_codec
+from ..query import plan
+
+MAGIC = 'TAXONSN1'
+HEADER = struct.Struct('<8sQQQQQ')
+
+
+def _ids(ids):
+    a = array('I', sorted(ids))
+    if sys.byteorder == 'big':
+        a.byteswap()
+    return a.tostring()
+
+
+def _encode_tag(tag):
+    return tag.encode('utf-8') if isinstance(tag, unicode) else tag
+
+
+def write_snapshot(path, tagged, codec=None):
+    """Write a snapshot of ``tagged``, a mapping of tags to sets of items, to
+    ``path``. The file is written next to ``path`` and renamed into place, so
+    readers never see a partial snapshot."""
+    codec = get_codec(codec)
+    ids = {}
+    for items in tagged.itervalues():
+        for item in items:
+            if item not in ids:
+                ids[item] = len(ids)
+    items = [None] * len(ids)
+    for item, i in ids.iteritems():
+        items[i] = item
+    # Tags are looked up by binary search over their UTF-8 bytes, so they
+    # are sorted encoded
+    tags = sorted((_encode_tag(tag), tag) for tag, items in tagged.iteritems() if items)
+
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, 0, 0, 0, 0, 0))
+        item_offsets = [f.tell()]
+        for data in (codec.encode(item) for item in items):
+            f.write(data)
+            item_offsets.append(f.tell())
+        tag_offsets = [f.tell()]
+        for encoded, _ in tags:
+            f.write(encoded)
+            tag_offsets.append(f.tell())
+        id_offsets = [f.tell()]
+        for _, tag in tags:
+            f.write(_ids(ids[item] for item in tagged[tag]))
+            id_offsets.append(f.tell())
+        indexes = []
+        for offsets in (item_offsets, tag_offsets, id_offsets):
+            indexes.append(f.tell())
+            f.write(struct.pack('<%dQ' % len(offsets), *offsets))
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, len(items), len(tags), *indexes))
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp, path)
+
+
+class SnapshotBackend(Backend):
+    "A read-only backend querying a snapshot file in place."
+
+    def __init__(self, path, codec=None):
+        self._path = path
+        self.codec = get_codec(codec)
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self._n_items, self._n_tags, self._item_index, self._tag_index, \
+            self._id_index = HEADER.unpack_from(self._map)
+        if magic != MAGIC:
+            raise ValueError("%r is not a Taxon snapshot" % path)
+
+    @property
+    def path(self):
+        return self._path
+
+    def _offsets(self, index, row):
+        return struct.unpack_from('<QQ', self._map, index + 8 * row)
+
+    def _tag(self, row):
+        start, end = self._offsets(self._tag_index, row)
+        return self._map[start:end]
+
+    def _tag_row(self, tag):
+        "Return the row of the tag, found by binary search, or ``None``."
+        tag = _encode_tag(tag)
+        lo, hi = 0, self._n_tags
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._tag(mid) < tag:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self._n_tags and self._tag(lo) == tag:
+            return lo
+        return None
+
+    def _tag_count(self, tag):
+        row = self._tag_row(tag)
+        if row is None:
+            return 0
+        return self._row_count(row)
+
+    def _row_count(self, row):
+        start, end = self._offsets(self._id_index, row)
+        return (end - start) // 4
+
+    def _tag_ids(self, tag):
+        row = self._tag_row(tag)
+        if row is None:
+            return array('I')
+        return self._row_ids(row)
+
+    def _row_ids(self, row):
+        start, end = self._offsets(self._id_index, row)
+        a = array('I')
+        a.fromstring(self._map[start:end])
+        if sys.byteorder == 'big':
+            a.byteswap()
+        return a
+
+    def _decode(self, ids):
+        data = []
+        for i in ids:
+            start, end = self._offsets(self._item_index, i)
+            data.append(self._map[start:end])
+        return self.codec.decode_many(data)
+
+    def tag_items(self, tag, *items):
+        raise NotImplementedError("snapshots are read-only")
+
+    def untag_items(self, tag, *items):
+        raise NotImplementedError("snapshots are read-only")
+
+    def remove_items(self, *items):
+        raise NotImplementedError("snapshots are read-only")
+
+    def all_tags(self):
+        return [self._tag(row) for row in xrange(self._n_tags)]
+
+    def all_items(self):
+        return self._decode(xrange(self._n_items))
+
+    def top_tags(self, n):
+        counts = ((row, self._row_count(row)) for row in xrange(self._n_tags))
+        return [(self._tag(row), count)
+                for row, count in heapq.nlargest(n, counts, key=itemgetter(1))]
+
+    def top_items(self, n):
+        # Item counts are not stored, so this reads every id array
+        counts = Counter()
+        for row in xrange(self._n_tags):
+            counts.update(self._row_ids(row))
+        top = counts.most_common(n)
+        return zip(self._decode([i for i, _ in top]), [count for _, count in top])
+
+    def tag_counts(self, tags):
+        return dict((tag, self._tag_count(tag)) for tag in tags)
+
+    def query(self, q):
+        return None, self._decode(self._query_ids(q))
+
+    def _query_ids(self, q):
+        fn, args = plan(q, self._tag_count, self._n_items)
+        return self._raw_query(fn, args)
+
+    def _raw_query(self, fn, args):
+        "Return the set of the ids of the items matching the planned node."
+        if fn == 'tag':
+            return set(self._tag_ids(args[0]))
+        elif fn == 'and':
+            result = self._raw_query(*args[0])
+            for a in args[1:]:
+                if not result:
+                    break
+                result &= self._raw_query(*a)
+            return result
+        elif fn == 'or':
+            return set().union(*[self._raw_query(*a) for a in args])
+        elif fn == 'not':
+            result = set(xrange(self._n_items))
+            for a in args:
+                result -= self._raw_query(*a)
+            return result
+        elif fn == 'diff':
+            result = self._raw_query(*args[0])
+            for a in args[1:]:
+                if not result:
+                    break
+                result -= self._raw_query(*a)
+            return result
+        else:
+            raise ValueError
+
+    def facets(self, q, tags=None):
+        ids = self._query_ids(q)
+        if tags is None:
+            rows = xrange(self._n_tags)
+        else:
+            rows = [row for row in imap(self._tag_row, tags) if row is not None]
+        counts = {}
+        for row in rows:
+            n = sum(1 for i in self._row_ids(row) if i in ids)
+            if n:
+                counts[self._tag(row)] = n
+        return counts
+
+    def count(self, q):
+        return len(self._query_ids(q))
+
+    def page(self, q, cursor=0, limit=100):
+        # Ids are ordered, so the cursor is the position in the sorted ids
+        ids = sorted(self._query_ids(q))
+        cursor = int(cursor)
+        page = ids[cursor:cursor + limit]
+        if cursor + limit < len(ids):
+            return cursor + limit, self._decode(page)
+        return 0, self._decode(page)
+
+    def close(self):
+        self._map.close()
+
+    def empty(self):
+        raise NotImplementedError("snapshots are read-only")
+
+    def __str__(self):
+        return unicode(self).encode('utf-8')
+
+    def __unicode__(self):
+        return u"%s(%r)" % (self.__class__.__name__, self.path)
@@ -0,0 +1,270 @@
+import sqlite3
+
+from .backend import Backend
+from ..codec import get_codec
+from ..query import plan
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tags (
+    id INTEGER PRIMARY KEY,
+    tag TEXT NOT NULL UNIQUE,
+    count INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS items (
+    id INTEGER PRIMARY KEY,
+    item BLOB NOT NULL UNIQUE,
+    count INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS tagged (
+    tag_id INTEGER NOT NULL,
+    item_id INTEGER NOT NULL,
+    PRIMARY KEY (tag_id, item_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS tagged_item ON tagged (item_id);
+CREATE INDEX IF NOT EXISTS tags_count ON tags (count);
+CREATE INDEX IF NOT EXISTS items_count ON items (count);
+"""
+
+# SQLite refuses compound selects of 500 terms or more by default
+MAX_COMPOUND_TERMS = 400
+
+
+def _compound(op, selects):
+    """Join the selects with the compound operator ``op``, nesting them in
+    groups small enough for SQLite."""
+    while len(selects) > MAX_COMPOUND_TERMS:
+        selects = ['SELECT * FROM (%s)' % (' %s ' % op).join(selects[i:i + MAX_COMPOUND_TERMS])
+                   for i in xrange(0, len(selects), MAX_COMPOUND_TERMS)]
+    return (' %s ' % op).join(selects)
+
+
+class SQLiteBackend(Backend):
+    """A persistent backend stored in a single SQLite database file.
+
+    The database is opened in WAL mode and every write runs in a transaction,
+    so a crash never leaves a half-applied write behind. Opening a store does
+    not load anything; pages are memory-mapped and read as queries need them,
+    and queries are compiled to one SQL statement of compound selects.
+    """
+
+    def __init__(self, path, codec=None, synchronous='NORMAL', mmap_size=1 << 30):
+        self._path = path
+        self.codec = get_codec(codec)
+        self._db = sqlite3.connect(path)
+        self._db.text_factory = str
+        self._db.execute('PRAGMA journal_mode = WAL')
+        self._db.execute('PRAGMA synchronous = %s' % synchronous)
+        self._db.execute('PRAGMA mmap_size = %d' % mmap_size)
+        self._db.executescript(SCHEMA)
+
+    @property
+    def path(self):
+        return self._path
+
+    def encode(self, item):
+        return sqlite3.Binary(self.codec.encode(item))
+
+    def decode_many(self, rows):
+        return self.codec.decode_many([str(item) for item, in rows])
+
+    def _tag_id(self, tag, create=False):
+        row = self._db.execute('SELECT id FROM tags WHERE tag = ?', (tag,)).fetchone()
+        if row is not None:
+            return row[0]
+        if create:
+            return self._db.execute('INSERT INTO tags (tag, count) VALUES (?, 0)', (tag,)).lastrowid
+
+    def _item_id(self, encoded, create=False):
+        row = self._db.execute('SELECT id FROM items WHERE item = ?', (encoded,)).fetchone()
+        if row is not None:
+            return row[0]
+        if create:
+            return self._db.execute('INSERT INTO items (item, count) VALUES (?, 0)', (encoded,)).lastrowid
+
+    def tag_items(self, tag, *items):
+        return self.tag_many({tag: items})[tag]
+
+    def tag_many(self, mapping):
+        added = {}
+        with self._db:
+            for tag, items in mapping.iteritems():
+                added[tag] = new_items = []
+                if not items:
+                    continue
+                tag_id = self._tag_id(tag, create=True)
+                for item in set(items):
+                    item_id = self._item_id(self.encode(item), create=True)
+                    cursor = self._db.execute(
+                        'INSERT OR IGNORE INTO tagged (tag_id, item_id) VALUES (?, ?)',
+                        (tag_id, item_id))
+                    if cursor.rowcount:
+                        self._db.execute('UPDATE items SET count = count + 1 WHERE id = ?',
+                                         (item_id,))
+                        new_items.append(item)
+                self._db.execute('UPDATE tags SET count = count + ? WHERE id = ?',
+                                 (len(new_items), tag_id))
+                self._db.execute('DELETE FROM tags WHERE id = ? AND count <= 0', (tag_id,))
+        return added
+
+    def untag_items(self, tag, *items):
+        removed = []
+        with self._db:
+            tag_id = self._tag_id(tag)
+            if tag_id is None:
+                return []
+            for item in set(items):
+                item_id = self._item_id(self.encode(item))
+                if item_id is None:
+                    continue
+                cursor = self._db.execute(
+                    'DELETE FROM tagged WHERE tag_id = ? AND item_id = ?', (tag_id, item_id))
+                if cursor.rowcount:
+                    self._db.execute('UPDATE items SET count = count - 1 WHERE id = ?',
+                                     (item_id,))
+                    self._db.execute('DELETE FROM items WHERE id = ? AND count <= 0', (item_id,))
+                    removed.append(item)
+            self._db.execute('UPDATE tags SET count = count - ? WHERE id = ?',
+                             (len(removed), tag_id))
+            self._db.execute('DELETE FROM tags WHERE id = ? AND count <= 0', (tag_id,))
+        return removed
+
+    def remove_items(self, *items):
+        removed = []
+        with self._db:
+            for item in set(items):
+                item_id = self._item_id(self.encode(item))
+                if item_id is None:
+                    continue
+                tags = 'SELECT tag_id FROM tagged WHERE item_id = ?'
+                self._db.execute('UPDATE tags SET count = count - 1 WHERE id IN (%s)' % tags,
+                                 (item_id,))
+                self._db.execute('DELETE FROM tags WHERE id IN (%s) AND count <= 0' % tags,
+                                 (item_id,))
+                self._db.execute('DELETE FROM tagged WHERE item_id = ?', (item_id,))
+                self._db.execute('DELETE FROM items WHERE id = ?', (item_id,))
+                removed.append(item)
+        return removed
+
+    def all_tags(self):
+        return [tag for tag, in self._db.execute('SELECT tag FROM tags')]
+
+    def all_items(self):
+        return self.decode_many(self._db.execute('SELECT item FROM items'))
+
+    def top_tags(self, n):
+        return self._db.execute('SELECT tag, count FROM tags ORDER BY count DESC LIMIT ?',
+                                (n,)).fetchall()
+
+    def top_items(self, n):
+        rows = self._db.execute('SELECT item, count FROM items ORDER BY count DESC LIMIT ?',
+                                (n,)).fetchall()
+        return zip(self.decode_many((item,) for item, _ in rows), [count for _, count in rows])
+
+    def tag_counts(self, tags):
+        tags = list(tags)
+        counts = dict((tag, 0) for tag in tags)
+        # Stay below the limit on the number of SQL variables
+        for i in xrange(0, len(tags), 500):
+            chunk = tags[i:i + 500]
+            counts.update(self._db.execute(
+                'SELECT tag, count FROM tags WHERE tag IN (%s)' % ','.join('?' * len(chunk)),
+                chunk))
+        return counts
+
+    def query(self, q):
+        sql, params = self._compile(q)
+        rows = self._db.execute('SELECT item FROM items WHERE id IN (%s)' % sql, params)
+        return None, self.decode_many(rows)
+
+    def _plan(self, q):
+        universe, = self._db.execute('SELECT COUNT(*) FROM items').fetchone()
+        return plan(q, self._tag_count, universe)
+
+    def _tag_count(self, tag):
+        row = self._db.execute('SELECT count FROM tags WHERE tag = ?', (tag,)).fetchone()
+        return row[0] if row is not None else 0
+
+    def _compile(self, q):
+        fn, args = self._plan(q)
+        params = []
+        sql = self._sql(fn, args, params)
+        return sql, params
+
+    def _sql(self, fn, args, params):
+        "Return a select of the ids of the items matching the planned node."
+        if fn == 'tag':
+            params.append(args[0])
+            return 'SELECT item_id FROM tagged WHERE tag_id = (SELECT id FROM tags WHERE tag = ?)'
+        if fn == 'or' and all(a[0] == 'tag' for a in args):
+            params.extend(a[1][0] for a in args)
+            return ('SELECT DISTINCT item_id FROM tagged WHERE tag_id IN '
+                    '(SELECT id FROM tags WHERE tag IN (%s))' % ','.join('?' * len(args)))
+        children = ['SELECT * FROM (%s)' % self._sql(a[0], a[1], params) for a in args]
+        if fn == 'and':
+            return _compound('INTERSECT', children)
+        elif fn == 'or':
+            return _compound('UNION', children)
+        elif fn == 'not':
+            return 'SELECT id FROM items EXCEPT SELECT * FROM (%s)' % _compound('UNION', children)
+        elif fn == 'diff':
+            if len(children) == 2:
+                return ' EXCEPT '.join(children)
+            return '%s EXCEPT SELECT * FROM (%s)' % (children[0], _compound('UNION', children[1:]))
+        else:
+            raise ValueError
+
+    def facets(self, q, tags=None):
+        sql, params = self._compile(q)
+        facets = ('SELECT tags.tag, COUNT(*) FROM tagged JOIN tags ON tags.id = tagged.tag_id '
+                  'WHERE tagged.item_id IN (%s)' % sql)
+        if tags is None:
+            return dict(self._db.execute(facets + ' GROUP BY tags.tag', params))
+        tags, counts = list(tags), {}
+        for i in xrange(0, len(tags), 500):
+            chunk = tags[i:i + 500]
+            counts.update(self._db.execute(
+                facets + ' AND tags.tag IN (%s) GROUP BY tags.tag' % ','.join('?' * len(chunk)),
+                params + chunk))
+        return counts
+
+    def count(self, q):
+        sql, params = self._compile(q)
+        count, = self._db.execute('SELECT COUNT(*) FROM (%s)' % sql, params).fetchone()
+        return count
+
+    def page(self, q, cursor=0, limit=100):
+        # The cursor is the id of the last item returned, so pages stay
+        # consistent while items are added or removed
+        sql, params = self._compile(q)
+        rows = self._db.execute(
+            'SELECT id, item FROM items WHERE id > ? AND id IN (%s) ORDER BY id LIMIT ?' % sql,
+            [int(cursor)] + params + [limit + 1]).fetchall()
+        items = self.decode_many((item,) for _, item in rows[:limit])
+        if len(rows) > limit:
+            return rows[limit - 1][0], items
+        return 0, items
+
+    def iter_query(self, q, batch_size=1000):
+        cursor = 0
+        while True:
+            cursor, items = self.page(q, cursor, batch_size)
+            for item in items:
+                yield item
+            if cursor == 0:
+                break
+
+    def close(self):
+        self._db.close()
+
+    def empty(self):
+        with self._db:
+            self._db.execute('DELETE FROM tagged')
+            self._db.execute('DELETE FROM tags')
+            self._db.execute('DELETE FROM items')
+
+    def __str__(self):
+        return unicode(self).encode('utf-8')
+
+    def __unicode__(self):
+        return u"%s(%r)" % (self.__class__.__name__, self.path)
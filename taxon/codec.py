@@ -0,0 +1,127 @@
+"""Codecs turn items into the byte strings stored by a backend and back.
+
+Backends decode whole batches with ``decode_many``, so a codec can decode a
+result in one call instead of one call per member.
+"""
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+__all__ = ['Codec', 'PickleCodec', 'RawCodec', 'StringCodec', 'IntCodec',
+           'MsgpackCodec', 'get_codec']
+
+
+class Codec(object):
+    "Base class of all codecs."
+
+    def encode(self, item):
+        raise NotImplementedError
+
+    def decode(self, data):
+        raise NotImplementedError
+
+    def decode_many(self, data):
+        return map(self.decode, data)
+
+    def __repr__(self):
+        return "%s()" % self.__class__.__name__
+
+
+class PickleCodec(Codec):
+    "Stores any picklable item. This is the default codec."
+
+    def encode(self, item):
+        return pickle.dumps(item)
+
+    def decode(self, data):
+        return pickle.loads(data)
+
+
+class RawCodec(Codec):
+    "Stores byte strings as they are."
+
+    def encode(self, item):
+        return item
+
+    def decode(self, data):
+        return data
+
+    def decode_many(self, data):
+        return list(data)
+
+
+class StringCodec(Codec):
+    "Stores unicode strings in the given encoding and decodes to unicode."
+
+    def __init__(self, encoding='utf-8'):
+        self.encoding = encoding
+
+    def encode(self, item):
+        if isinstance(item, unicode):
+            return item.encode(self.encoding)
+        return item
+
+    def decode(self, data):
+        return data.decode(self.encoding)
+
+    def decode_many(self, data):
+        encoding = self.encoding
+        return [d.decode(encoding) for d in data]
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, self.encoding)
+
+
+class IntCodec(Codec):
+    "Stores integers as their decimal representation."
+
+    def encode(self, item):
+        return str(int(item))
+
+    def decode(self, data):
+        return int(data)
+
+    def decode_many(self, data):
+        return map(int, data)
+
+
+class MsgpackCodec(Codec):
+    "Stores items serialized with msgpack. Requires the msgpack package."
+
+    def __init__(self):
+        import msgpack
+        self._msgpack = msgpack
+
+    def encode(self, item):
+        return self._msgpack.packb(item, use_bin_type=True)
+
+    def decode(self, data):
+        return self._msgpack.unpackb(data, raw=False)
+
+    def decode_many(self, data):
+        unpacker = self._msgpack.Unpacker(raw=False)
+        unpacker.feed(''.join(data))
+        return list(unpacker)
+
+
+CODECS = {
+    'pickle': PickleCodec,
+    'raw': RawCodec,
+    'string': StringCodec,
+    'int': IntCodec,
+    'msgpack': MsgpackCodec,
+}
+
+
+def get_codec(codec=None):
+    """Return a codec instance from a codec, the name of a built-in codec, or
+    ``None`` for the default pickle codec."""
+    if codec is None:
+        return PickleCodec()
+    elif isinstance(codec, Codec):
+        return codec
+    elif codec in CODECS:
+        return CODECS[codec]()
+    else:
+        raise ValueError("%r is not a valid codec" % (codec,))
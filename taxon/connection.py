@@ -0,0 +1,95 @@
+"""Redis connection handling for ``RedisTaxon``.
+
+Connection pools are shared by every client created for the same DSN in a
+process, so short-lived ``RedisTaxon`` instances reuse connections instead of
+opening their own.
+"""
+import threading
+from urlparse import urlparse, parse_qsl, unquote
+
+__all__ = ['parse_dsn', 'connection_pool', 'redis_from_dsn']
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def _bool(value):
+    if value.lower() in ('1', 'true', 'yes', 'on'):
+        return True
+    elif value.lower() in ('0', 'false', 'no', 'off'):
+        return False
+    raise ValueError("%r is not a boolean" % value)
+
+
+DSN_OPTIONS = {
+    'db': int,
+    'max_connections': int,
+    'socket_timeout': float,
+    'socket_connect_timeout': float,
+    'socket_keepalive': _bool,
+    'retry_on_timeout': _bool,
+    'ssl_keyfile': str,
+    'ssl_certfile': str,
+    'ssl_cert_reqs': str,
+    'ssl_ca_certs': str,
+}
+
+
+def parse_dsn(dsn):
+    """Return the ``redis.ConnectionPool`` arguments described by a DSN.
+
+    TCP, TLS and unix socket connections are supported, with an optional
+    password, database and pool or socket options in the query string::
+
+        redis://[:password@]host[:port][/db][?option=value...]
+        rediss://[:password@]host[:port][/db][?option=value...]
+        unix://[:password@]/path/to/socket[?db=db&option=value...]
+
+    The options are ``db``, ``max_connections``, ``socket_timeout``,
+    ``socket_connect_timeout``, ``socket_keepalive``, ``retry_on_timeout``
+    and, for ``rediss``, ``ssl_keyfile``, ``ssl_certfile``, ``ssl_cert_reqs``
+    and ``ssl_ca_certs``.
+
+    >>> parse_dsn('redis://:secret@localhost:6380/2?socket_timeout=0.5')['port']
+    6380
+    """
+    import redis
+    # urlparse only splits the query string off schemes it knows about
+    dsn, _, query = dsn.partition('?')
+    parts = urlparse(dsn)
+    _, _, password = parts.netloc.rpartition('@')[0].rpartition(':')
+    kwargs = {'password': unquote(password) or None}
+    if parts.scheme == 'unix':
+        kwargs['connection_class'] = redis.UnixDomainSocketConnection
+        kwargs['path'] = unquote(parts.path)
+        kwargs['db'] = 0
+    elif parts.scheme in ('redis', 'rediss'):
+        if parts.scheme == 'rediss':
+            kwargs['connection_class'] = redis.SSLConnection
+        host, _, port = parts.netloc.rpartition('@')[2].partition(':')
+        kwargs['host'] = host or 'localhost'
+        kwargs['port'] = int(port or 6379)
+        kwargs['db'] = int(parts.path.strip('/') or 0)
+    else:
+        raise ValueError("Unknown DSN scheme in %r" % dsn)
+    for name, value in parse_qsl(query):
+        if name not in DSN_OPTIONS:
+            raise ValueError("Unknown DSN option %r" % name)
+        kwargs[name] = DSN_OPTIONS[name](value)
+    return kwargs
+
+
+def connection_pool(dsn):
+    "Return the connection pool shared by every client of the DSN."
+    with _pools_lock:
+        pool = _pools.get(dsn)
+        if pool is None:
+            import redis
+            pool = _pools[dsn] = redis.ConnectionPool(**parse_dsn(dsn))
+        return pool
+
+
+def redis_from_dsn(dsn):
+    "Return a Redis client using the shared connection pool of the DSN."
+    import redis
+    return redis.Redis(connection_pool=connection_pool(dsn))
@@ -1,21 +1,38 @@
-from urlparse import urlparse
+import heapq
+import logging
+import time
+from operator import itemgetter
 
-from .backends import Backend, MemoryBackend, RedisBackend
-from .query import Query
+from .backends import (Backend, BitmapBackend, MemoryBackend, RedisBackend, ShardedRedisBackend,
+                       SQLiteBackend)
+from .connection import redis_from_dsn
+from .query import PreparedQuery, Query, freeze
+
+slow_query_log = logging.getLogger('taxon.slow_query')
 
 
 class Taxon(object):
     """A Taxon instance provides methods to organize and query data by tag.
     """
 
-    def __init__(self, backend):
+    def __init__(self, backend, stats=None, slow_query_time=None):
         """Create a new instance to access the data stored in the backend.
 
         >>> Taxon(MemoryBackend())
+
+        Operations are measured when a ``taxon.stats.Stats`` object is given,
+        and queries taking at least ``slow_query_time`` seconds are logged
+        with their query tree to the ``taxon.slow_query`` logger.
+
+        >>> Taxon(MemoryBackend(), stats=Stats(), slow_query_time=0.5)
         """
         if not isinstance(backend, Backend):
             raise ValueError("%r is not a valid backend" % backend)
         self._backend = backend
+        self._stats = stats
+        self._slow_query_time = slow_query_time
+        if stats is not None:
+            backend.stats = stats
 
     @property
     def backend(self):
@@ -28,7 +45,39 @@ class Taxon(object):
         >>> t = Taxon(MemoryBackend())
         >>> t.tag('closed', 'issue-91', 'issue-105', 'issue-4')
         """
-        return self.backend.tag_items(tag, *items)
+        return self._call('tag', None, self.backend.tag_items, tag, *items)
+
+    def tag_many(self, mapping):
+        """Add each tag in ``mapping`` to the items it maps to, and return a
+        mapping of each tag to the items that were newly tagged.
+
+        >>> t = Taxon(MemoryBackend())
+        >>> t.tag_many({'closed': ['issue-91', 'issue-4'], 'bug': ['issue-4']})
+        {'closed': ['issue-91', 'issue-4'], 'bug': ['issue-4']}
+        """
+        return self._call('tag_many', None, self.backend.tag_many, mapping)
+
+    def load(self, pairs, chunk_size=10000):
+        """Tag items from an iterable of ``(tag, item)`` pairs.
+
+        The pairs are consumed lazily and written ``chunk_size`` at a time,
+        grouped by tag. Returns the number of new tag assignments. The
+        ``taxon.loader`` module has readers for CSV and JSON lines files.
+
+        >>> t = Taxon(MemoryBackend())
+        >>> t.load([('closed', 'issue-91'), ('closed', 'issue-4'), ('bug', 'issue-4')])
+        3
+        """
+        loaded = 0
+        chunk = {}
+        for i, (tag, item) in enumerate(pairs, 1):
+            chunk.setdefault(tag, []).append(item)
+            if i % chunk_size == 0:
+                loaded += sum(map(len, self.tag_many(chunk).itervalues()))
+                chunk = {}
+        if chunk:
+            loaded += sum(map(len, self.tag_many(chunk).itervalues()))
+        return loaded
 
     def untag(self, tag, *items):
         """Remove tag ``tag`` from each element in ``items``.
@@ -36,7 +85,7 @@ class Taxon(object):
         >>> t = Taxon(MemoryBackend())
         >>> t.untag('closed', 'issue-91')
         """
-        return self.backend.untag_items(tag, *items)
+        return self._call('untag', None, self.backend.untag_items, tag, *items)
 
     def remove(self, *items):
         """Remove each element in ``items`` from the store.
@@ -45,7 +94,7 @@ class Taxon(object):
         >>> t.tag('functional', 'Haskell', 'Pure', 'ML', 'C')
         >>> t.remove('C')
         """
-        return self.backend.remove_items(*items)
+        return self._call('remove', None, self.backend.remove_items, *items)
 
     def tags(self):
         """Return a list of all the tags known to the store.
@@ -57,7 +106,7 @@ class Taxon(object):
         >>> t.tags()
         ['water', 'fire', 'grass']
         """
-        return self.backend.all_tags()
+        return self._call('tags', None, self.backend.all_tags)
 
     def items(self):
         """Return a list of all the items in the store.
@@ -69,7 +118,56 @@ class Taxon(object):
         >>> t.items()
         ['Squirtle', 'Charmander', 'Bulbasaur']
         """
-        return self.backend.all_items()
+        return self._call('items', None, self.backend.all_items)
+
+    def top_tags(self, n=10):
+        """Return the ``n`` tags with the most items, with their item counts,
+        most used first.
+
+        >>> t = Taxon(MemoryBackend())
+        >>> t.tag('water', 'Squirtle', 'Psyduck')
+        >>> t.tag('fire', 'Charmander')
+        >>> t.top_tags(1)
+        [('water', 2)]
+        """
+        return self._call('top_tags', None, self.backend.top_tags, n)
+
+    def top_items(self, n=10):
+        """Return the ``n`` items with the most tags, with their tag counts,
+        most tagged first.
+
+        >>> t = Taxon(MemoryBackend())
+        >>> t.tag('water', 'Squirtle', 'Lapras')
+        >>> t.tag('ice', 'Lapras')
+        >>> t.top_items(1)
+        [('Lapras', 2)]
+        """
+        return self._call('top_items', None, self.backend.top_items, n)
+
+    def tag_counts(self, tags):
+        """Return a dict of the number of items of each tag in ``tags``.
+
+        >>> t = Taxon(MemoryBackend())
+        >>> t.tag('water', 'Squirtle', 'Lapras')
+        >>> t.tag_counts(['water', 'fire'])
+        {'water': 2, 'fire': 0}
+        """
+        return self._call('tag_counts', None, self.backend.tag_counts, tags)
+
+    def prepare(self, q):
+        """Return a prepared form of the query, which every query method
+        accepts. It is canonicalized once, so equivalent queries share cached
+        results, and backends keep what they compile it to for reuse.
+
+        >>> t = Taxon(MemoryBackend())
+        >>> t.tag('ice', 'Dewgong', 'Articuno')
+        >>> q = t.prepare(Tag('ice') & ~Tag('water'))
+        >>> t.count(q)
+        2
+        """
+        if not isinstance(q, (tuple, Query)):
+            raise ValueError("%r is not a valid query" % q)
+        return PreparedQuery(q)
 
     def query(self, q):
         """Perform a query and return the results and metadata.
@@ -86,7 +184,90 @@ class Taxon(object):
         """
         if not isinstance(q, (tuple, Query)):
             raise ValueError("%r is not a valid query" % q)
-        return self.backend.query(q)
+        return self._call('query', q, self.backend.query, q)
+
+    def count(self, q):
+        """Return the number of items matching the query.
+
+        >>> t = Taxon(MemoryBackend())
+        >>> t.tag('ice', 'Dewgong', 'Articuno')
+        >>> t.count(Tag('ice'))
+        2
+        """
+        if not isinstance(q, (tuple, Query)):
+            raise ValueError("%r is not a valid query" % q)
+        return self._call('count', q, self.backend.count, q)
+
+    def query_many(self, queries, count=False):
+        """Return the list of items matching each query in ``queries``, or
+        their number with ``count``.
+
+        The in-memory backends evaluate the batch together when NumPy is
+        installed, computing each subexpression shared by the queries once
+        as a vectorized bit operation.
+
+        >>> t = Taxon(MemoryBackend())
+        >>> t.tag('ice', 'Dewgong', 'Articuno')
+        >>> t.tag('flying', 'Articuno', 'Pidgeotto')
+        >>> t.query_many([Tag('ice') & Tag('flying'), ~Tag('ice')], count=True)
+        [1, 1]
+        """
+        queries = list(queries)
+        for q in queries:
+            if not isinstance(q, (tuple, Query)):
+                raise ValueError("%r is not a valid query" % q)
+        return self._call('query_many', None, self.backend.query_many, queries, count)
+
+    def page(self, q, cursor=0, limit=100):
+        """Return a page of the items matching the query.
+
+        The result is a ``(cursor, items)`` tuple. Passing the cursor back
+        returns the next page, and a cursor of ``0`` means there are no more
+        pages. The Redis backend pages with ``SSCAN``, so ``limit`` is only a
+        hint there and pages may be slightly larger or smaller.
+
+        >>> t = Taxon(MemoryBackend())
+        >>> t.tag('ice', 'Dewgong', 'Articuno')
+        >>> t.page(Tag('ice'), limit=1)
+        (1, ['Articuno'])
+        """
+        if not isinstance(q, (tuple, Query)):
+            raise ValueError("%r is not a valid query" % q)
+        return self._call('page', q, self.backend.page, q, cursor, limit)
+
+    def iter_query(self, q, batch_size=1000):
+        """Return an iterator over the items matching the query, which are
+        fetched from the backend ``batch_size`` at a time.
+
+        >>> t = Taxon(MemoryBackend())
+        >>> t.tag('ice', 'Dewgong', 'Articuno')
+        >>> list(t.iter_query(Tag('ice')))
+        ['Articuno', 'Dewgong']
+        """
+        if not isinstance(q, (tuple, Query)):
+            raise ValueError("%r is not a valid query" % q)
+        return self.backend.iter_query(q, batch_size)
+
+    def facets(self, q, tags=None, top=None):
+        """Return the number of items matching the query that carry each tag,
+        as ``(tag, count)`` pairs, largest first. Only the counts of ``tags``
+        are returned if given, and only the ``top`` largest if given; tags
+        none of the items carry are left out.
+
+        >>> t = Taxon(MemoryBackend())
+        >>> t.tag('water', 'Squirtle', 'Lapras', 'Psyduck')
+        >>> t.tag('ice', 'Lapras')
+        >>> t.facets(Tag('water'), top=2)
+        [('water', 3), ('ice', 1)]
+        """
+        if not isinstance(q, (tuple, Query)):
+            raise ValueError("%r is not a valid query" % q)
+        if tags is not None:
+            tags = list(tags)
+        counts = self._call('facets', q, self.backend.facets, q, tags)
+        if top is None:
+            return sorted(counts.iteritems(), key=itemgetter(1), reverse=True)
+        return heapq.nlargest(top, counts.iteritems(), key=itemgetter(1))
 
     def find(self, q):
         """Return a set of the items matching the query, ignoring metadata.
@@ -113,6 +294,37 @@ class Taxon(object):
         """
         return self.backend.empty()
 
+    def stats(self):
+        """Return a snapshot of the measurements of the stats object, or
+        ``None`` when the instance has none. See ``taxon.stats.Stats``.
+
+        >>> t = Taxon(MemoryBackend(), stats=Stats())
+        >>> t.tag('ice', 'Dewgong', 'Articuno')
+        >>> t.stats()['operations']['tag']['calls']
+        1
+        """
+        if self._stats is None:
+            return None
+        return self._stats.snapshot()
+
+    def _call(self, operation, q, fn, *args):
+        "Call ``fn``, measuring it and logging it if it is a slow query."
+        stats, slow_query_time = self._stats, self._slow_query_time
+        if stats is None and (slow_query_time is None or q is None):
+            return fn(*args)
+        start = time.time()
+        if stats is None:
+            result = fn(*args)
+        else:
+            with stats.operation(operation):
+                result = fn(*args)
+                if operation in ('query', 'page'):
+                    stats.incr('items', len(result[1]))
+        elapsed = time.time() - start
+        if q is not None and slow_query_time is not None and elapsed >= slow_query_time:
+            slow_query_log.warning("%s took %.3fs: %r", operation, elapsed, freeze(q))
+        return result
+
     def __str__(self):
         return unicode(self).encode('utf-8')
 
@@ -123,9 +335,24 @@ class Taxon(object):
 class MemoryTaxon(Taxon):
     """A utility class to quickly create a memory-backed Taxon instance."""
 
+    def __init__(self, cache_size=0):
+        """Create a new Taxon instance with a memory backend, caching the
+        results of up to ``cache_size`` query nodes."""
+        super(MemoryTaxon, self).__init__(MemoryBackend(cache_size))
+
+    def __str__(self):
+        return unicode(self).encode('utf-8')
+
+    def __unicode__(self):
+        return u"%s()" % (self.__class__.__name__)
+
+
+class BitmapTaxon(Taxon):
+    """A utility class to quickly create a bitmap-backed Taxon instance."""
+
     def __init__(self):
-        """Create a new Taxon instance with a memory backend."""
-        super(MemoryTaxon, self).__init__(MemoryBackend())
+        """Create a new Taxon instance with a bitmap backend."""
+        super(BitmapTaxon, self).__init__(BitmapBackend())
 
     def __str__(self):
         return unicode(self).encode('utf-8')
@@ -134,46 +361,107 @@ class MemoryTaxon(Taxon):
         return u"%s()" % (self.__class__.__name__)
 
 
+class SQLiteTaxon(Taxon):
+    """A utility class to quickly create a Taxon instance persisted in a
+    SQLite database file."""
+
+    def __init__(self, path, **options):
+        """Create a new Taxon instance with a SQLite backend, creating the
+        database file if it does not exist yet.
+
+        >>> t = SQLiteTaxon('/var/lib/tags.db')
+
+        Any other keyword arguments are passed on to the ``SQLiteBackend``.
+
+        >>> t = SQLiteTaxon('/var/lib/tags.db', codec='string', synchronous='FULL')
+        """
+        super(SQLiteTaxon, self).__init__(SQLiteBackend(path, **options))
+
+    def __str__(self):
+        return unicode(self).encode('utf-8')
+
+    def __unicode__(self):
+        return u"%s(%r)" % (self.__class__.__name__, self.backend.path)
+
+
 class RedisTaxon(Taxon):
     """A utility class to quickly create a Redis-backed Taxon instance."""
 
-    def __init__(self, dsn='redis://localhost', name='txn'):
+    def __init__(self, dsn='redis://localhost', name='txn', replicas=None, **options):
         """Create a new Taxon instance with a Redis backend.
 
         A DSN is used to specify the Redis server to connect to. The path part
-        of the DSN can be used to specify which database to select.
+        of the DSN can be used to specify which database to select, and the
+        query string sets pool and socket options. Connections are pooled and
+        shared with every other instance using the same DSN. See
+        ``taxon.connection.parse_dsn`` for the supported forms.
 
         >>> t = RedisTaxon('redis://localhost:6379/10')
+        >>> t = RedisTaxon('rediss://:secret@redis.internal/0?max_connections=20&socket_timeout=0.5')
+        >>> t = RedisTaxon('unix:///var/run/redis.sock?db=10')
+
+        Reads can be spread over read replicas by listing their DSNs. Writes,
+        and the scans of ``page`` and ``iter_query``, always go to the
+        primary.
+
+        >>> t = RedisTaxon('redis://primary', replicas=['redis://replica-1', 'redis://replica-2'])
 
         The name of the instance is used as a namespacing mechanism, so that
         multiple Taxon instances can use the same Redis database without
         clobbering each others' data.
 
         >>> t = RedisTaxon(name='my-other-blog')
+
+        Any other keyword arguments are passed on to the ``RedisBackend``.
+
+        >>> t = RedisTaxon(cache_ttl=300, cache_size=10000)
         """
         self._dsn = dsn
         r = self._redis_from_dsn(self._dsn)
-        super(RedisTaxon, self).__init__(RedisBackend(r, name))
+        if replicas:
+            options['replicas'] = [self._redis_from_dsn(d) for d in replicas]
+        super(RedisTaxon, self).__init__(RedisBackend(r, name, **options))
 
     def _redis_from_dsn(self, dsn):
         """Return a Redis instance from a string DSN."""
-        import redis
-        parts = urlparse(dsn)
-        _, _, netloc = parts.netloc.partition('@')
-        netloc = netloc.rsplit(':')
-        host = netloc[0]
-        try:
-            port = int(netloc[1])
-        except IndexError:
-            port = 6379
-        try:
-            db = int(parts.path.strip('/'))
-        except ValueError:
-            db = 0
-        return redis.Redis(host=host, port=port, db=db)
+        return redis_from_dsn(dsn)
 
     def __str__(self):
         return unicode(self).encode('utf-8')
 
     def __unicode__(self):
         return u"%s(%r, %r)" % (self.__class__.__name__, self._dsn, self.backend.name)
+
+
+class ShardedRedisTaxon(Taxon):
+    """A utility class to quickly create a Taxon instance sharded over
+    several Redis nodes."""
+
+    def __init__(self, dsns, name='txn', **options):
+        """Create a new Taxon instance with a sharded Redis backend.
+
+        Every DSN names one shard, in the forms accepted by ``RedisTaxon``.
+        The order of the DSNs places the shards on the hash ring, so it must
+        stay the same between instances. New nodes are added at the end with
+        ``add_shard``.
+
+        >>> t = ShardedRedisTaxon(['redis://node-1', 'redis://node-2'])
+        >>> t.add_shard('redis://node-3')
+
+        Any other keyword arguments are passed on to every ``RedisBackend``.
+        """
+        self._dsns = list(dsns)
+        redises = [redis_from_dsn(dsn) for dsn in self._dsns]
+        super(ShardedRedisTaxon, self).__init__(ShardedRedisBackend(redises, name, **options))
+
+    def add_shard(self, dsn):
+        """Add a Redis node as a new shard and move the items it takes over to
+        it. Return the number of items moved."""
+        self._dsns.append(dsn)
+        return self.backend.add_shard(redis_from_dsn(dsn))
+
+    def __str__(self):
+        return unicode(self).encode('utf-8')
+
+    def __unicode__(self):
+        return u"%s(%r, %r)" % (self.__class__.__name__, self._dsns, self.backend.name)
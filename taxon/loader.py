@@ -0,0 +1,55 @@
+"""Readers that stream ``(tag, item)`` pairs out of files for ``Taxon.load``.
+
+Both readers accept a path or an open file object and yield pairs lazily, so
+files larger than memory can be loaded.
+"""
+import csv
+import json
+from contextlib import contextmanager
+
+__all__ = ['read_csv', 'read_jsonl']
+
+
+@contextmanager
+def _opened(f, mode='r'):
+    if isinstance(f, basestring):
+        with open(f, mode) as fp:
+            yield fp
+    else:
+        yield f
+
+
+def read_csv(f, tag_column=0, item_column=1, skip_header=False, **fmtparams):
+    """Yield a ``(tag, item)`` pair for every row of a CSV file.
+
+    Extra keyword arguments are passed on to ``csv.reader``.
+
+    >>> t.load(read_csv('assignments.csv', skip_header=True))
+    """
+    with _opened(f, 'rb') as fp:
+        rows = csv.reader(fp, **fmtparams)
+        if skip_header:
+            next(rows, None)
+        for row in rows:
+            if row:
+                yield row[tag_column], row[item_column]
+
+
+def read_jsonl(f, tag_field='tag', item_field='item'):
+    """Yield a ``(tag, item)`` pair for every line of a JSON lines file.
+
+    Each line is either a ``[tag, item]`` array or an object with the tag and
+    item stored under ``tag_field`` and ``item_field``.
+
+    >>> t.load(read_jsonl('assignments.jsonl'))
+    """
+    with _opened(f) as fp:
+        for line in fp:
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            if isinstance(record, dict):
+                yield record[tag_field], record[item_field]
+            else:
+                yield record[0], record[1]
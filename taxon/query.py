@@ -71,3 +71,211 @@ class Not(Query):
 
     def freeze(self):
         return ("not", tuple([self.expr.freeze()]))
+
+
+def freeze(q):
+    "Returns the tuple representation of ``q``, which may already be a tuple."
+    if isinstance(q, Query):
+        return q.freeze()
+    elif isinstance(q, tuple):
+        return q
+    else:
+        raise TypeError("%s is not a recognized Taxon query" % (q,))
+
+
+def query_tags(q):
+    "Returns the set of tags referenced anywhere in the query."
+    fn, args = freeze(q)
+    if fn == 'tag':
+        return set(args)
+    tags = set()
+    for a in args:
+        tags.update(query_tags(a))
+    return tags
+
+
+class Planner(object):
+    """
+    Rewrites the tuple representation of a query into an equivalent plan
+    that is cheaper to execute.
+
+    Nested ``and`` and ``or`` nodes are flattened and their duplicate
+    operands dropped, double negations cancel out, ``and`` operands are
+    ordered from the smallest to the largest estimated result so that
+    backends can stop as soon as an intersection is empty, and negated
+    operands of an ``and`` become a ``diff`` node so the universe of items
+    is never materialized for them.
+
+    ``cardinality`` is a function returning the number of items carrying a
+    tag, and ``universe`` is the number of items in the store. Without them
+    only the structural rewrites are applied. Estimates only order operands;
+    an operand is dropped only when it is certainly empty.
+    """
+
+    def __init__(self, cardinality=None, universe=None):
+        self.cardinality = cardinality
+        self.universe = universe
+
+    def plan(self, q):
+        "Returns the optimized tuple representation of the query."
+        fn, args = freeze(q)
+        if fn == 'tag':
+            if len(args) == 1:
+                return ('tag', (args[0],))
+            return self.plan(('or', tuple(('tag', (t,)) for t in args)))
+        elif fn == 'and':
+            return self._plan_and([self.plan(a) for a in args])
+        elif fn == 'or':
+            return self._plan_or([self.plan(a) for a in args])
+        elif fn == 'not':
+            if len(args) != 1:
+                return self.plan(('not', (('or', tuple(args)),)))
+            child = self.plan(args[0])
+            if child[0] == 'not':
+                return child[1][0]
+            return ('not', (child,))
+        elif fn == 'diff':
+            positive = self.plan(args[0])
+            return self._plan_and([positive] + [('not', (self.plan(a),)) for a in args[1:]])
+        else:
+            raise ValueError("Unknown Taxon operator '%s'" % fn)
+
+    def estimate(self, node):
+        "Returns the estimated number of items matched by a planned node."
+        fn, args = node
+        if fn == 'tag':
+            if self.cardinality is None:
+                return 1
+            return self.cardinality(args[0]) or 0
+        elif fn == 'and':
+            return min(self.estimate(a) for a in args)
+        elif fn == 'or':
+            total = sum(self.estimate(a) for a in args)
+            if self.universe is not None:
+                return min(total, self.universe)
+            return total
+        elif fn == 'not':
+            if self.universe is None:
+                return self.estimate(args[0]) + 1
+            return max(self.universe - self.estimate(args[0]), 0)
+        elif fn == 'diff':
+            return self.estimate(args[0])
+
+    def empty(self, node):
+        "Returns whether a planned node certainly matches no items."
+        fn, args = node
+        if fn == 'tag':
+            return self.cardinality is not None and not self.cardinality(args[0])
+        elif fn == 'and':
+            return any(self.empty(a) for a in args)
+        elif fn == 'or':
+            return all(self.empty(a) for a in args)
+        elif fn == 'not':
+            return self.universe == 0
+        elif fn == 'diff':
+            return self.empty(args[0])
+
+    def _plan_and(self, children):
+        positive, negative = [], []
+        for child in self._flatten('and', children):
+            if child[0] == 'not':
+                negative.extend(self._flatten('or', child[1]))
+            elif child[0] == 'diff':
+                positive.append(child[1][0])
+                negative.extend(child[1][1:])
+            else:
+                positive.append(child)
+        positive = _unique(self._flatten('and', positive))
+        negative = _unique(negative)
+        if not positive:
+            return ('not', (self._plan_or(negative),))
+        positive.sort(key=self.estimate)
+        node = positive[0] if len(positive) == 1 else ('and', tuple(positive))
+        if self.empty(node) or not negative:
+            return node
+        negative.sort(key=self.estimate, reverse=True)
+        return ('diff', (node,) + tuple(negative))
+
+    def _plan_or(self, children):
+        children = _unique(self._flatten('or', children))
+        if self.cardinality is not None:
+            nonempty = [c for c in children if not self.empty(c)]
+            children = nonempty or children[:1]
+        if len(children) == 1:
+            return children[0]
+        return ('or', tuple(children))
+
+    def _flatten(self, fn, children):
+        flat = []
+        for child in children:
+            if child[0] == fn:
+                flat.extend(self._flatten(fn, child[1]))
+            else:
+                flat.append(child)
+        return flat
+
+
+def _unique(nodes):
+    seen = set()
+    unique = []
+    for node in nodes:
+        if node not in seen:
+            seen.add(node)
+            unique.append(node)
+    return unique
+
+
+def plan(q, cardinality=None, universe=None):
+    "Returns an optimized tuple representation of the query."
+    return Planner(cardinality, universe).plan(q)
+
+
+def canonical(q):
+    """Returns the structural plan of the query with the operands of ``and``
+    and ``or`` nodes sorted, so that equivalent queries such as
+    ``Tag('a') & Tag('b')`` and ``Tag('b') & Tag('a')`` are equal."""
+    return _sorted(plan(q))
+
+
+def _sorted(node):
+    fn, args = node
+    if fn == 'tag':
+        return node
+    args = tuple(_sorted(a) for a in args)
+    if fn in ('and', 'or'):
+        args = tuple(sorted(args))
+    elif fn == 'diff':
+        args = args[:1] + tuple(sorted(args[1:]))
+    return (fn, args)
+
+
+class PreparedQuery(Query):
+    """
+    A query canonicalized once, for repeated execution.
+
+    Freezing a prepared query returns its canonical tuple representation
+    without walking the expression again. Backends whose plans do not depend
+    on the data store what they compile the query to in ``compiled``, keyed
+    by backend, so that later executions skip planning and hashing.
+    """
+
+    def __init__(self, q):
+        self.tree = canonical(q)
+        self.tags = frozenset(query_tags(self.tree))
+        self.compiled = {}
+        self._hash = hash(self.tree)
+
+    def freeze(self):
+        return self.tree
+
+    def __eq__(self, other):
+        return isinstance(other, PreparedQuery) and self.tree == other.tree
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return self._hash
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, self.tree)
@@ -0,0 +1,157 @@
+"""Instrumentation of Taxon operations.
+
+A ``Stats`` object given to a ``Taxon`` instance records the latency, result
+size and errors of every operation, counters reported by the backend while
+the operation runs, such as Redis round trips or cache hits, and the time
+spent evaluating each kind of query node in the in-process backends::
+
+    t = Taxon(MemoryBackend(), stats=Stats(), slow_query_time=0.1)
+    t.stats()['operations']['query']['p99']
+
+Subclass ``Stats`` and override ``record``, ``incr`` or ``node`` to forward
+the measurements to another metrics system.
+"""
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+__all__ = ['Histogram', 'Stats']
+
+
+class Histogram(object):
+    """A histogram of durations in logarithmic buckets, each twice as wide as
+    the one before, starting from one microsecond."""
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        bucket = max(0, int(math.ceil(math.log(max(seconds, 1e-6) * 1e6, 2))))
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, p):
+        "Return the upper bound of the bucket holding the ``p``th percentile."
+        if not self.count:
+            return None
+        rank = p / 100.0 * self.count
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return min((2 ** bucket) / 1e6, self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            'calls': self.count,
+            'seconds': self.total,
+            'mean': self.total / self.count if self.count else None,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'max': self.max,
+        }
+
+
+class Stats(object):
+    "Collects the measurements of a Taxon instance. It is thread-safe."
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._operations = {}
+            self._nodes = {}
+            self._counters = {}
+
+    @contextmanager
+    def operation(self, name):
+        """Time the operation run in the block. Counters incremented by the
+        same thread meanwhile are attributed to it."""
+        stack = self._local.__dict__.setdefault('stack', [])
+        stack.append({})
+        start = time.time()
+        failed = True
+        try:
+            yield
+            failed = False
+        finally:
+            seconds = time.time() - start
+            self.record(name, seconds, counters=stack.pop(), failed=failed)
+
+    def record(self, operation, seconds, counters=None, failed=False):
+        with self._lock:
+            op = self._operations.get(operation)
+            if op is None:
+                op = self._operations[operation] = {
+                    'histogram': Histogram(), 'errors': 0, 'counters': {}}
+            op['histogram'].add(seconds)
+            if failed:
+                op['errors'] += 1
+            for name, n in (counters or {}).iteritems():
+                op['counters'][name] = op['counters'].get(name, 0) + n
+
+    def incr(self, counter, n=1):
+        with self._lock:
+            self._counters[counter] = self._counters.get(counter, 0) + n
+            # Frames may be shared with other threads through ``attach``
+            for frame in getattr(self._local, 'stack', ()):
+                frame[counter] = frame.get(counter, 0) + n
+
+    def frames(self):
+        "Return the operations the calling thread is running, for ``attach``."
+        return list(getattr(self._local, 'stack', ()))
+
+    @contextmanager
+    def attach(self, frames):
+        """Attribute the counters incremented by the calling thread in the
+        block to ``frames``, the operations another thread is running."""
+        stack = self._local.__dict__.get('stack')
+        self._local.stack = list(frames)
+        try:
+            yield
+        finally:
+            if stack is None:
+                del self._local.stack
+            else:
+                self._local.stack = stack
+
+    def node(self, fn, seconds):
+        "Record the time spent evaluating a query node, including its children."
+        with self._lock:
+            histogram = self._nodes.get(fn)
+            if histogram is None:
+                histogram = self._nodes[fn] = Histogram()
+            histogram.add(seconds)
+
+    def snapshot(self):
+        """Return the measurements so far as a dict of plain values.
+
+        ``operations`` maps every operation to its call count, latency
+        percentiles in seconds, error count and the total and per call
+        values of the counters incremented while it ran. ``nodes`` maps every
+        query node type to its evaluation latencies, and ``counters`` holds
+        the totals of all counters."""
+        with self._lock:
+            operations = {}
+            for name, op in self._operations.iteritems():
+                summary = op['histogram'].summary()
+                summary['errors'] = op['errors']
+                summary['counters'] = dict(op['counters'])
+                summary['per_call'] = dict((c, float(n) / summary['calls'])
+                                           for c, n in op['counters'].iteritems())
+                operations[name] = summary
+            nodes = dict((fn, h.summary()) for fn, h in self._nodes.iteritems())
+            return {'operations': operations, 'nodes': nodes,
+                    'counters': dict(self._counters)}
+
@@ -1,10 +1,16 @@
+import os
+import shutil
+import tempfile
 from functools import partial
 from nose.tools import raises, eq_, ok_
 from .context import taxon, benchmark
-from taxon import MemoryTaxon, RedisTaxon
+from taxon import Taxon, BitmapTaxon, MemoryTaxon, RedisTaxon, ShardedRedisTaxon, SQLiteTaxon
+from taxon.backends import ConcurrentMemoryBackend, MemoryBackend, ParallelMemoryBackend
 from taxon.query import *
 
 TestRedisTaxon = partial(RedisTaxon, 'redis://localhost:6379/9', 'test')
+TestShardedRedisTaxon = partial(ShardedRedisTaxon, ['redis://localhost:6379/10',
+                                                    'redis://localhost:6379/11'], 'test')
 
 
 class _TestBasics(object):
@@ -33,6 +39,35 @@ class _TestBasics(object):
         tagged = self.t.tag('bar', 'x')
         eq_(tagged, [])
 
+    def test_tag_many(self):
+        tagged = self.t.tag_many({'foo': ['a', 'b'], 'bar': ['b']})
+        eq_(set(tagged['foo']), set(['a', 'b']))
+        eq_(tagged['bar'], ['b'])
+        tagged = self.t.tag_many({'foo': ['a', 'c'], 'baz': []})
+        eq_(tagged, {'foo': ['c'], 'baz': []})
+        eq_(set(self.t.tags()), set(['foo', 'bar']))
+        eq_(set(self.t.items()), set(['a', 'b', 'c']))
+        eq_(self.t.find(Tag('foo')), set(['a', 'b', 'c']))
+
+    def test_load(self):
+        pairs = [('foo', 'a'), ('foo', 'b'), ('bar', 'b'), ('foo', 'a'), ('bar', 'c')]
+        eq_(self.t.load(iter(pairs), chunk_size=2), 4)
+        eq_(self.t.find(Tag('foo')), set(['a', 'b']))
+        eq_(self.t.find(Tag('bar')), set(['b', 'c']))
+        eq_(self.t.remove('b'), ['b'])
+        eq_(set(self.t.items()), set(['a', 'c']))
+
+    def test_not_tracks_live_items(self):
+        self.t.tag('foo', 'x', 'y', 'z')
+        self.t.tag('bar', 'y')
+        eq_(self.t.find(Not('bar')), set(['x', 'z']))
+        self.t.untag('foo', 'x')
+        eq_(self.t.find(Not('bar')), set(['z']))
+        self.t.remove('z')
+        eq_(self.t.find(Not('bar')), set())
+        self.t.tag('baz', 'w')
+        eq_(self.t.find(Not('bar')), set(['w']))
+
     def test_all_tags(self):
         self.t.tag('foo', 'x', 'y')
         self.t.tag('bar', 'y', 'z')
@@ -43,6 +78,48 @@ class _TestBasics(object):
         self.t.tag('bar', 'y', 'z')
         eq_(set(self.t.items()), set(['x', 'y', 'z']))
 
+    def test_top(self):
+        self.t.tag('foo', 'x', 'y', 'z')
+        self.t.tag('bar', 'y', 'z')
+        self.t.tag('baz', 'z')
+        self.t.untag('foo', 'x')
+        eq_(sorted(self.t.top_tags(2)), [('bar', 2), ('foo', 2)])
+        eq_(self.t.top_tags(5)[-1], ('baz', 1))
+        eq_(self.t.top_items(1), [('z', 3)])
+        eq_(sorted(self.t.top_items(5)), [('y', 2), ('z', 3)])
+        eq_(self.t.tag_counts(['foo', 'baz', 'missing']), {'foo': 2, 'baz': 1, 'missing': 0})
+        eq_(self.t.tag_counts([]), {})
+        eq_(self.t.top_tags(0), [])
+        eq_(self.t.top_items(0), [])
+
+    def test_write_while_iterating(self):
+        self.t.tag('foo', 'x', 'y', 'z')
+        results = self.t.iter_query(Tag('foo'), batch_size=1)
+        results.next()
+        self.t.tag('foo', *range(100))
+        self.t.remove('x', 'y', 'z')
+        ok_(len(list(results)) <= 102)
+
+    def test_negation_in_or(self):
+        # The estimated size of the negation is 0, but it matches 'w'
+        self.t.tag('a', 'x', 'y')
+        self.t.tag('b', 'x', 'y')
+        self.t.tag('c', 'x')
+        self.t.tag('d', 'w')
+        eq_(self.t.find(Tag('c') | ~(Tag('a') | Tag('b'))), set(['x', 'w']))
+        eq_(self.t.count(Tag('c') | ~(Tag('a') | Tag('b'))), 2)
+
+    def test_facets(self):
+        self.t.tag('foo', 'x', 'y', 'z')
+        self.t.tag('bar', 'y', 'z')
+        self.t.tag('baz', 'z', 'w')
+        eq_(self.t.facets(Tag('foo')), [('foo', 3), ('bar', 2), ('baz', 1)])
+        eq_(self.t.facets(Tag('foo'), top=2), [('foo', 3), ('bar', 2)])
+        eq_(sorted(self.t.facets(Not('foo'))), [('baz', 1)])
+        eq_(self.t.facets(Tag('bar'), tags=['baz', 'missing']), [('baz', 1)])
+        eq_(self.t.facets(Tag('missing')), [])
+        eq_(self.t.facets(Tag('foo'), tags=[]), [])
+
     def test_remove_tag(self):
         self.t.tag('bar', 'x', 'y')
         untagged = self.t.untag('bar', 'x')
@@ -72,11 +149,133 @@ class _TestBasics(object):
         eq_(self.t.tags(), ['foo'])
         eq_(self.t.items(), ['z'])
 
+    def test_remove_untagged_item(self):
+        self.t.tag('foo', 'x', 'y')
+        self.t.tag('bar', 'x')
+        self.t.untag('foo', 'x')
+        removed = self.t.remove('x', 'y', 'w')
+        eq_(set(removed), set(['x', 'y']))
+        eq_(self.t.tags(), [])
+        eq_(self.t.items(), [])
+        eq_(self.t.tag('foo', 'x'), ['x'])
+        eq_(self.t.find(Tag('foo')), set(['x']))
+
 
 class TestMemoryBasics(_TestBasics):
     def __init__(self):
         super(TestMemoryBasics, self).__init__(MemoryTaxon)
 
+    def test_counters_drop_zero_counts(self):
+        self.t.tag('foo', 'x', 'y')
+        self.t.tag('bar', 'x')
+        self.t.untag('foo', 'x', 'y')
+        self.t.remove('x')
+        backend = self.t.backend
+        eq_(dict(backend.tags), {})
+        eq_(dict(backend.items), {})
+        eq_(backend.tagged, {})
+        eq_(backend.item_tags, {})
+        eq_(self.t.untag('missing', 'x'), [])
+
+
+class TestConcurrentMemoryBasics(_TestBasics):
+    def __init__(self):
+        super(TestConcurrentMemoryBasics, self).__init__(
+            lambda: Taxon(ConcurrentMemoryBackend()))
+
+    def test_readers_see_consistent_state(self):
+        # The writer always tags and removes items with foo and bar together,
+        # so no snapshot may hold an item with only one of them
+        from threading import Thread
+        done, errors = [], []
+
+        def write():
+            for i in range(300):
+                self.t.tag_many({'foo': [i, i + 1], 'bar': [i, i + 1]})
+                self.t.remove(i - 1)
+            done.append(True)
+
+        def read():
+            try:
+                while not done:
+                    eq_(self.t.find(Or(And('foo', Not('bar')), And('bar', Not('foo')))), set())
+                    ok_(self.t.count(Tag('foo')) <= 3)
+            except Exception, e:
+                errors.append(e)
+
+        threads = [Thread(target=write)] + [Thread(target=read) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        eq_(errors, [])
+        eq_(self.t.find(Tag('foo')), set([299, 300]))
+        eq_(self.t.backend.item_tags, {299: set(['foo', 'bar']), 300: set(['foo', 'bar'])})
+
+    def test_top_items_without_lock(self):
+        self.t.tag_many({'foo': ['x', 'y'], 'bar': ['x']})
+        with self.t.backend._lock:
+            eq_(self.t.top_items(1), [('x', 2)])
+
+    def test_cache_stats(self):
+        self.t.tag('foo', 'x')
+        self.t.find(Tag('foo') & ~Tag('bar'))
+        eq_(self.t.backend.cache_stats(), {'hits': 0, 'misses': 0, 'evictions': 0,
+                                           'invalidations': 0, 'size': 0})
+
+
+class TestParallelMemoryBasics(_TestBasics):
+    def __init__(self):
+        super(TestParallelMemoryBasics, self).__init__(
+            lambda: Taxon(ParallelMemoryBackend(workers=2, min_items=0)))
+
+    def teardown(self):
+        super(TestParallelMemoryBasics, self).teardown()
+        self.t.backend.close()
+
+    def test_pool(self):
+        self.t.tag('foo', *range(100))
+        backend = self.t.backend
+        eq_(sorted(len(shard.universe) for shard in backend._shards), [50, 50])
+        eq_(self.t.count(Not('foo')), 0)
+        pool = backend._pool
+        ok_(pool is not None)
+        eq_(self.t.count(Tag('foo')), 100)
+        ok_(backend._pool is pool)
+        self.t.untag('foo', 1)
+        ok_(backend._pool is None)
+        eq_(self.t.find(Not('foo')), set())
+        small = ParallelMemoryBackend(workers=2)
+        Taxon(small).tag('foo', 'x')
+        eq_(Taxon(small).find(Tag('foo')), set(['x']))
+        ok_(small._pool is None)
+        small.close()
+
+    def test_garbage_collected(self):
+        import gc
+        import weakref
+        backend = ParallelMemoryBackend(workers=2, min_items=0)
+        Taxon(backend).tag('foo', 'x')
+        eq_(Taxon(backend).count(Tag('foo')), 1)
+        shard = weakref.ref(backend._shards[0])
+        del backend
+        gc.collect()
+        ok_(shard() is None)
+
+
+class TestBitmapBasics(_TestBasics):
+    def __init__(self):
+        super(TestBitmapBasics, self).__init__(BitmapTaxon)
+
+    def test_reused_ids(self):
+        self.t.tag('foo', 'x', 'y')
+        self.t.tag('bar', 'y')
+        self.t.remove('x')
+        self.t.tag('bar', 'z')
+        eq_(self.t.find(Tag('foo')), set(['y']))
+        eq_(self.t.find(Tag('bar')), set(['y', 'z']))
+        eq_(self.t.find(Not('foo')), set(['z']))
+
 
 class TestRedisBasics(_TestBasics):
     def __init__(self):
@@ -90,3 +289,261 @@ class TestRedisBasics(_TestBasics):
     def teardown(self):
         super(TestRedisBasics, self).teardown()
         self.t.backend.redis.flushdb()
+
+    def test_codec(self):
+        t = TestRedisTaxon(codec='int')
+        eq_(sorted(t.tag('foo', 1, '2', 3)), [1, 2, 3])
+        eq_(t.backend.redis.smembers(t.backend.tag_key('foo')), set(['1', '2', '3']))
+        eq_(t.find(Tag('foo')), set([1, 2, 3]))
+        eq_(t.remove(2), [2])
+
+    def test_replicas(self):
+        # The replica is an empty database, so reads it answers are empty
+        # while queries it cannot answer fall back to the primary
+        t = TestRedisTaxon(replicas=['redis://localhost:6379/8'])
+        if t.backend.replicas[0].dbsize() > 0:
+            raise RuntimeError("Redis database is not empty")
+        t.tag('foo', 'x', 'y')
+        t.tag('bar', 'y')
+        eq_(t.tags(), [])
+        eq_(t.find(Tag('foo')), set())
+        eq_(t.find(And('foo', 'bar')), set(['y']))
+        eq_(t.count(Or('foo', 'bar')), 2)
+        eq_(sorted(t.page(Tag('foo'))[1]), ['x', 'y'])
+        eq_(sorted(t.iter_query(Tag('foo'), batch_size=1)), ['x', 'y'])
+        eq_(self.t.tags(), ['bar', 'foo'])
+
+    def test_empty_tag_ends_intersection(self):
+        self.t.tag('a', *range(100))
+        self.t.tag('b', *range(50, 150))
+        eq_(self.t.find(And(Or('a', 'b'), 'missing')), set())
+        eq_(self.t.find(And(Or('a', 'b'), Not('a'), 'missing')), set())
+        eq_(self.t.backend.cache_stats()['size'], 0)
+        eq_(self.t.find(And(Or('a', 'b'), 'b')), set(range(50, 150)))
+
+    def test_rebuild_indexes(self):
+        # Stores written before the reverse index and the universe of items
+        # have neither
+        from redis.exceptions import ResponseError
+        self.t.tag('foo', 'x', 'y')
+        self.t.tag('bar', 'y', 'z')
+        r, backend = self.t.backend.redis, self.t.backend
+        for item in ['x', 'y', 'z']:
+            r.delete(backend.item_key(backend.encode(item)))
+        r.delete(backend.universe_key)
+        try:
+            self.t.remove('x')
+        except ResponseError:
+            pass
+        else:
+            raise AssertionError("removing an unindexed item did not fail")
+        eq_(self.t.find(Tag('foo')), set(['x', 'y']))
+        r.sadd(backend.legacy_cache_key, backend.result_key('old'))
+        eq_(self.t.find(Tag('foo') & Tag('bar')), set(['y']))
+        backend.rebuild_indexes(batch_size=1)
+        ok_(not r.exists(backend.legacy_cache_key))
+        eq_(self.t.find(~Tag('foo')), set(['z']))
+        eq_(self.t.remove('y'), ['y'])
+        eq_(self.t.find(Tag('bar')), set(['z']))
+        eq_(self.t.find(Tag('foo')), set(['x']))
+
+    def test_tag_bytes(self):
+        self.t.tag('foo', 'y')
+        for tag, stored in [(u'caf\xe9', 'caf\xc3\xa9'), ('\xff\xfe', '\xff\xfe')]:
+            self.t.tag(tag, 'x', 'y')
+            eq_(self.t.find(Tag(tag) & Tag('foo')), set(['y']))
+            eq_(self.t.find(Tag(tag) & ~Tag('foo')), set(['x']))
+            eq_(self.t.facets(Tag(tag), tags=[tag]), [(stored, 2)])
+
+    def test_result_keys_do_not_collide(self):
+        self.t.tag('x', 'a', 'b')
+        self.t.tag('y', 'a')
+        self.t.tag('z', 'a', 'b')
+        self.t.tag('x,%s' % self.t.backend.tag_key('y'), 'b')
+        eq_(self.t.find(And('x', 'y', 'z')), set(['a']))
+        eq_(self.t.find(And('x,%s' % self.t.backend.tag_key('y'), 'z')), set(['b']))
+
+    def test_prepared_queries(self):
+        self.t.tag('foo', 'x', 'y')
+        self.t.tag('bar', 'y', 'z')
+        key, _ = self.t.query(Tag('bar') & Tag('foo'))
+        q = self.t.prepare(Tag('foo') & Tag('bar'))
+        eq_(self.t.query(q), (key, ['y']))
+        ok_(q.compiled)
+        self.t.tag('foo', 'z')
+        eq_(sorted(self.t.query(q)[1]), ['y', 'z'])
+
+    def test_concurrent_counters(self):
+        from threading import Thread
+        items = range(100)
+        writers = [Thread(target=TestRedisTaxon().tag, args=['foo'] + items)
+                   for _ in range(4)]
+        for w in writers:
+            w.start()
+        for w in writers:
+            w.join()
+        r, backend = self.t.backend.redis, self.t.backend
+        eq_(r.zscore(backend.tags_key, 'foo'), 100)
+        eq_(set(r.zrange(backend.items_key, 0, -1, withscores=True)),
+            set((backend.encode(i), 1) for i in items))
+
+
+class TestShardedRedisBasics(_TestBasics):
+    def __init__(self):
+        super(TestShardedRedisBasics, self).__init__(TestShardedRedisTaxon)
+
+    def setup(self):
+        super(TestShardedRedisBasics, self).setup()
+        if any(shard.redis.dbsize() for shard in self.t.backend.shards):
+            raise RuntimeError("Redis database is not empty")
+
+    def teardown(self):
+        super(TestShardedRedisBasics, self).teardown()
+        self.t.backend.close()
+
+    def test_close(self):
+        import threading
+        threads = threading.active_count()
+        backend = TestShardedRedisTaxon().backend
+        ok_(threading.active_count() > threads)
+        backend.close()
+        eq_(threading.active_count(), threads)
+        TestShardedRedisTaxon()
+        eq_(threading.active_count(), threads)
+
+    def test_items_live_on_one_shard(self):
+        items = range(100)
+        self.t.tag('foo', *items)
+        self.t.tag('bar', *items[::2])
+        sizes = []
+        for shard in self.t.backend.shards:
+            shard_items = set(shard.all_items())
+            eq_(set(shard.query(Tag('bar'))[1]), shard_items & set(items[::2]))
+            sizes.append(len(shard_items))
+        eq_(sum(sizes), 100)
+        ok_(min(sizes) > 0)
+
+    def test_add_shard(self):
+        items = range(200)
+        self.t.tag('foo', *items)
+        self.t.tag('bar', *items[::3])
+        r = TestRedisTaxon().backend.redis
+        if r.dbsize() > 0:
+            raise RuntimeError("Redis database is not empty")
+        pool = self.t.backend._pool
+        try:
+            moved = self.t.add_shard('redis://localhost:6379/9')
+            ok_(not any(worker.is_alive() for worker in pool._pool))
+            shards = self.t.backend.shards
+            eq_(len(shards), 3)
+            eq_(moved, len(shards[2].all_items()))
+            ok_(0 < moved < 200)
+            eq_(sum(len(s.all_items()) for s in shards), 200)
+            eq_(self.t.find(Tag('bar')), set(items[::3]))
+            eq_(self.t.find(Not('bar')), set(items) - set(items[::3]))
+            eq_(self.t.count(Tag('foo')), 200)
+        finally:
+            r.flushdb()
+
+
+class TestSQLiteBasics(_TestBasics):
+    def __init__(self):
+        super(TestSQLiteBasics, self).__init__(lambda: SQLiteTaxon(self.path))
+
+    def setup(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'taxon.db')
+        super(TestSQLiteBasics, self).setup()
+
+    def teardown(self):
+        super(TestSQLiteBasics, self).teardown()
+        self.t.backend.close()
+        shutil.rmtree(self.dir)
+
+    def test_persistence(self):
+        self.t.tag('foo', 'x', 'y')
+        self.t.tag('bar', 'y', 'z')
+        self.t.untag('foo', 'x')
+        t = SQLiteTaxon(self.path)
+        eq_(set(t.tags()), set(['foo', 'bar']))
+        eq_(set(t.items()), set(['y', 'z']))
+        eq_(t.find(And('foo', 'bar')), set(['y']))
+        t.backend.close()
+
+    def test_many_operands(self):
+        # SQLite limits compound selects to fewer than 500 terms
+        tags = ['t%d' % i for i in range(600)]
+        self.t.tag_many(dict((tag, ['x', tag]) for tag in tags))
+        self.t.tag('common', 'x')
+        eq_(len(self.t.find(Or(*tags))), 601)
+        eq_(self.t.find(And(*tags)), set(['x']))
+        eq_(self.t.count(Or(*[And(tag, 'common') for tag in tags])), 1)
+        eq_(len(self.t.find(Or(*[And(tag, Not('common')) for tag in tags]))), 600)
+        eq_(self.t.find(And('t0', Not(Or(*[And(tag, 'common') for tag in tags[1:]])))),
+            set(['t0']))
+
+    def test_failed_write_is_rolled_back(self):
+        # Lambdas cannot be pickled, so the write fails part way through
+        self.t.tag('foo', 'x')
+        items = ['y%d' % i for i in range(50)] + [lambda: None]
+        try:
+            self.t.tag('foo', *items)
+        except Exception:
+            pass
+        else:
+            ok_(False)
+        eq_(self.t.find(Tag('foo')), set(['x']))
+        eq_(self.t.tags(), ['foo'])
+
+
+class TestCachedMemoryBasics(_TestBasics):
+    def __init__(self):
+        super(TestCachedMemoryBasics, self).__init__(lambda: Taxon(MemoryBackend(cache_size=4)))
+
+    def test_cache(self):
+        backend = self.t.backend
+        self.t.tag('foo', 'x', 'y')
+        self.t.tag('bar', 'y', 'z')
+        self.t.tag('baz', 'w')
+        q = Or('foo', 'bar')
+        eq_(self.t.find(q), set(['x', 'y', 'z']))
+        eq_(self.t.find(q), set(['x', 'y', 'z']))
+        eq_(backend.cache_stats(), {'hits': 1, 'misses': 1, 'evictions': 0,
+                                    'invalidations': 0, 'size': 1})
+        # Writes to other tags leave the result valid
+        self.t.tag('baz', 'v')
+        eq_(self.t.find(q), set(['x', 'y', 'z']))
+        eq_(backend.cache_stats()['hits'], 2)
+        self.t.untag('bar', 'z')
+        eq_(self.t.find(q), set(['x', 'y']))
+        eq_(backend.cache_stats()['invalidations'], 1)
+
+    def test_cache_universe(self):
+        self.t.tag('foo', 'x')
+        eq_(self.t.find(Not('bar')), set(['x']))
+        self.t.tag('baz', 'y')
+        eq_(self.t.find(Not('bar')), set(['x', 'y']))
+        self.t.remove('x', 'y')
+        self.t.tag('bar', 'z')
+        eq_(self.t.find(Not('bar')), set())
+        eq_(self.t.backend.cache_stats()['hits'], 0)
+
+    def test_cache_returning_tag(self):
+        self.t.tag('foo', 'x')
+        eq_(self.t.find(And('foo', 'bar')), set())
+        self.t.tag('bar', 'x')
+        eq_(self.t.find(And('foo', 'bar')), set(['x']))
+        self.t.remove('x')
+        self.t.tag('foo', 'x')
+        eq_(self.t.find(And('foo', 'bar')), set())
+
+    def test_cache_bounds(self):
+        tags = ['a', 'b', 'c', 'd', 'e', 'f']
+        self.t.tag('foo', 'y')
+        for tag in tags:
+            self.t.tag(tag, 'x')
+        for tag in tags:
+            self.t.find(Or('foo', tag))
+        stats = self.t.backend.cache_stats()
+        eq_(stats['size'], 4)
+        eq_(stats['evictions'], 2)
@@ -0,0 +1,48 @@
+from nose.plugins.skip import SkipTest
+from nose.tools import raises, eq_, ok_
+from .context import taxon
+from taxon.codec import *
+
+
+def check_round_trip(codec, items):
+    encoded = [codec.encode(item) for item in items]
+    ok_(all(isinstance(e, str) for e in encoded))
+    eq_([codec.decode(e) for e in encoded], items)
+    eq_(codec.decode_many(encoded), items)
+
+
+def test_pickle():
+    check_round_trip(PickleCodec(), ['a', 1, (2, 'b'), None])
+
+
+def test_raw():
+    check_round_trip(RawCodec(), ['a', '\x00\xff'])
+
+
+def test_string():
+    check_round_trip(StringCodec(), [u'a', u'caf\xe9'])
+    eq_(StringCodec('latin-1').encode(u'caf\xe9'), 'caf\xe9')
+
+
+def test_int():
+    check_round_trip(IntCodec(), [0, -5, 2 ** 70])
+
+
+def test_msgpack():
+    try:
+        codec = MsgpackCodec()
+    except ImportError:
+        raise SkipTest("msgpack is not installed")
+    check_round_trip(codec, [u'a', 1, [2, u'b'], {u'c': None}, '\x00\xff'])
+
+
+def test_get_codec():
+    ok_(isinstance(get_codec(), PickleCodec))
+    ok_(isinstance(get_codec('int'), IntCodec))
+    codec = StringCodec('latin-1')
+    ok_(get_codec(codec) is codec)
+
+
+@raises(ValueError)
+def test_get_invalid_codec():
+    get_codec('yaml')
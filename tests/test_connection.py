@@ -0,0 +1,51 @@
+import redis
+from nose.tools import raises, eq_, ok_
+from .context import taxon
+from taxon.connection import parse_dsn, connection_pool, redis_from_dsn
+
+
+def test_parse_tcp():
+    eq_(parse_dsn('redis://localhost'),
+        {'host': 'localhost', 'port': 6379, 'db': 0, 'password': None})
+    eq_(parse_dsn('redis://:s%40cret@example.com:6380/3'),
+        {'host': 'example.com', 'port': 6380, 'db': 3, 'password': 's@cret'})
+
+
+def test_parse_options():
+    kwargs = parse_dsn('redis://localhost/1?max_connections=5&socket_timeout=0.5'
+                       '&retry_on_timeout=yes')
+    eq_(kwargs['max_connections'], 5)
+    eq_(kwargs['socket_timeout'], 0.5)
+    eq_(kwargs['retry_on_timeout'], True)
+
+
+def test_parse_tls():
+    kwargs = parse_dsn('rediss://redis.internal?ssl_cert_reqs=required')
+    ok_(kwargs['connection_class'] is redis.SSLConnection)
+    eq_(kwargs['ssl_cert_reqs'], 'required')
+
+
+def test_parse_unix():
+    kwargs = parse_dsn('unix://:pw@/var/run/redis.sock?db=4')
+    ok_(kwargs['connection_class'] is redis.UnixDomainSocketConnection)
+    eq_(kwargs['path'], '/var/run/redis.sock')
+    eq_(kwargs['db'], 4)
+    eq_(kwargs['password'], 'pw')
+
+
+@raises(ValueError)
+def test_parse_unknown_scheme():
+    parse_dsn('http://localhost')
+
+
+@raises(ValueError)
+def test_parse_unknown_option():
+    parse_dsn('redis://localhost?pool=3')
+
+
+def test_shared_pool():
+    dsn = 'redis://localhost:6379/7?max_connections=3'
+    ok_(connection_pool(dsn) is connection_pool(dsn))
+    ok_(redis_from_dsn(dsn).connection_pool is redis_from_dsn(dsn).connection_pool)
+    ok_(connection_pool(dsn) is not connection_pool('redis://localhost:6379/7'))
+    eq_(connection_pool(dsn).max_connections, 3)
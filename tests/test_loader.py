@@ -0,0 +1,21 @@
+from StringIO import StringIO
+from nose.tools import eq_
+from .context import taxon
+from taxon.loader import read_csv, read_jsonl
+
+
+def test_read_csv():
+    f = StringIO('tag,item\nfire,charmander\n\nwater,squirtle\n')
+    eq_(list(read_csv(f, skip_header=True)),
+        [('fire', 'charmander'), ('water', 'squirtle')])
+
+
+def test_read_csv_columns():
+    f = StringIO('charmander\tfire\n')
+    eq_(list(read_csv(f, tag_column=1, item_column=0, delimiter='\t')),
+        [('fire', 'charmander')])
+
+
+def test_read_jsonl():
+    f = StringIO('{"tag": "fire", "item": "charmander"}\n\n["water", 7]\n')
+    eq_(list(read_jsonl(f)), [('fire', 'charmander'), ('water', 7)])
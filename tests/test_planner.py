@@ -0,0 +1,88 @@
+from nose.tools import raises, eq_, ok_
+from .context import taxon
+from taxon.query import *
+from taxon.query import PreparedQuery, canonical, plan
+
+counts = {'a': 10, 'b': 2, 'c': 5, 'empty': 0}
+
+
+def plan_with_counts(q):
+    return plan(q, counts.get, 20)
+
+
+def test_tag():
+    eq_(plan(Tag('a')), ('tag', ('a',)))
+    eq_(plan(('tag', ['a', 'b'])), ('or', (('tag', ('a',)), ('tag', ('b',)))))
+
+
+def test_flatten():
+    eq_(plan(And(And('a', 'b'), 'c')),
+        ('and', (('tag', ('a',)), ('tag', ('b',)), ('tag', ('c',)))))
+    eq_(plan(Or('a', Or('b', 'c'))),
+        ('or', (('tag', ('a',)), ('tag', ('b',)), ('tag', ('c',)))))
+
+
+def test_deduplicate():
+    eq_(plan(And('a', 'a')), ('tag', ('a',)))
+    eq_(plan(Or('a', Or('a', 'b'))), ('or', (('tag', ('a',)), ('tag', ('b',)))))
+
+
+def test_double_negation():
+    eq_(plan(Not(Not('a'))), ('tag', ('a',)))
+
+
+def test_order_by_cardinality():
+    eq_(plan_with_counts(And('a', 'b', 'c')),
+        ('and', (('tag', ('b',)), ('tag', ('c',)), ('tag', ('a',)))))
+
+
+def test_empty_operand():
+    eq_(plan_with_counts(And('a', 'empty', Not('b'))), ('and', (('tag', ('empty',)), ('tag', ('a',)))))
+    eq_(plan_with_counts(Or('a', 'empty')), ('tag', ('a',)))
+    eq_(plan_with_counts(Or('empty', 'missing')), ('tag', ('empty',)))
+
+
+def test_negation_is_never_pruned():
+    # The estimate of the negation is 0, but it is not certainly empty
+    q = Or('b', Not(Or('a', 'c', 'a2')))
+    eq_(plan(q, dict(counts, a2=10).get, 20),
+        ('or', (('tag', ('b',)), ('not', (('or', (('tag', ('a',)), ('tag', ('c',)),
+                                                  ('tag', ('a2',)))),)))))
+    eq_(plan_with_counts(And('empty', Not('a'))), ('tag', ('empty',)))
+
+
+def test_difference():
+    eq_(plan(And('a', Not('b'))), ('diff', (('tag', ('a',)), ('tag', ('b',)))))
+    eq_(plan_with_counts(And(Not('b'), 'a', Not(Or('c', 'b')))),
+        ('diff', (('tag', ('a',)), ('tag', ('c',)), ('tag', ('b',)))))
+
+
+def test_de_morgan():
+    eq_(plan(And(Not('a'), Not('b'))),
+        ('not', (('or', (('tag', ('a',)), ('tag', ('b',)))),)))
+
+
+def test_idempotent():
+    q = And(Or('a', 'c'), Not('b'), 'c')
+    eq_(plan_with_counts(plan_with_counts(q)), plan_with_counts(q))
+
+
+def test_canonical():
+    eq_(canonical(Tag('b') & Tag('a')), canonical(Tag('a') & Tag('b')))
+    eq_(canonical(Or('c', And('b', 'a'), 'c')), canonical(Or(And('a', 'b'), 'c')))
+    eq_(canonical(And('a', Not('c'), Not('b'))),
+        ('diff', (('tag', ('a',)), ('tag', ('b',)), ('tag', ('c',)))))
+
+
+def test_prepared():
+    q = PreparedQuery(Tag('b') & Tag('a') & Tag('a'))
+    eq_(q.freeze(), ('and', (('tag', ('a',)), ('tag', ('b',)))))
+    eq_(q.tags, frozenset(['a', 'b']))
+    eq_(q, PreparedQuery(And('a', 'b')))
+    eq_(hash(q), hash(PreparedQuery(And('a', 'b'))))
+    eq_(plan(q | 'c'), plan(Or(And('a', 'b'), 'c')))
+
+
+@raises(ValueError)
+def test_unknown_operator():
+    plan(('xor', (('tag', ['a']),)))
@@ -1,11 +1,17 @@
+import os
+import shutil
+import tempfile
 from functools import partial
 from os.path import dirname
 from nose.tools import raises, eq_, ok_
 from .context import taxon, benchmark
-from taxon import MemoryTaxon, RedisTaxon
+from taxon import Taxon, BitmapTaxon, MemoryTaxon, RedisTaxon, ShardedRedisTaxon, SQLiteTaxon
+from taxon.backends import ConcurrentMemoryBackend, MemoryBackend, ParallelMemoryBackend
 from taxon.query import *
 
 TestRedisTaxon = partial(RedisTaxon, 'redis://localhost:6379/9', 'test')
+TestShardedRedisTaxon = partial(ShardedRedisTaxon, ['redis://localhost:6379/10',
+                                                    'redis://localhost:6379/11'], 'test')
 
 
 class _TestBackend(object):
@@ -66,6 +72,29 @@ class _TestBackend(object):
         ok_(len(results) > 0)
         eq_(len(results), 11)
 
+    def test_find_and_not(self):
+        # Find all flying types that are neither normal nor water type
+        results = self.t.find(And('flying', Not('normal')))
+        eq_(len(results), 60)
+        results = self.t.find(Tag('flying') & ~Tag('normal') & ~Tag('water'))
+        eq_(len(results), 52)
+        results = self.t.find(And(Not('fire'), Not('water')))
+        eq_(len(results), 490)
+
+    def test_find_nested(self):
+        results = self.t.find(And(And('flying', 'dragon'), And('ground', 'flying')))
+        eq_(len(results), 0)
+        results = self.t.find(Or(Or('grass', 'poison'), 'grass'))
+        eq_(len(results), 119)
+        results = self.t.find(Not(Not('water')))
+        eq_(len(results), 111)
+
+    def test_find_missing_tag(self):
+        results = self.t.find(And('water', 'no-such-tag'))
+        eq_(len(results), 0)
+        results = self.t.find(Or('water', 'no-such-tag'))
+        eq_(len(results), 111)
+
     def test_find_all(self):
         tags = self.t.tags()
         # Find all items by providing every tag
@@ -77,6 +106,79 @@ class _TestBackend(object):
         eq_(len(results), len(self.t.items()))
         eq_(set(results), set(self.t.items()))
 
+    def test_top(self):
+        tags = self.t.tags()
+        counts = dict((tag, self.t.count(Tag(tag))) for tag in tags)
+        top = self.t.top_tags(5)
+        eq_(len(top), 5)
+        for tag, count in top:
+            eq_(count, counts[tag])
+        eq_([c for _, c in top], sorted(counts.values(), reverse=True)[:5])
+        eq_(self.t.tag_counts(tags + ['missing']), dict(counts, missing=0))
+        item_counts = {}
+        for tag in tags:
+            for item in self.t.find(Tag(tag)):
+                item_counts[item] = item_counts.get(item, 0) + 1
+        top = self.t.top_items(3)
+        for item, count in top:
+            eq_(count, item_counts[item])
+        eq_([c for _, c in top], sorted(item_counts.values(), reverse=True)[:3])
+
+    def test_facets(self):
+        q = Or('flying', 'water')
+        results = self.t.find(q)
+        tags = self.t.tags()
+        expected = {}
+        for tag in tags:
+            n = len(results & self.t.find(Tag(tag)))
+            if n:
+                expected[tag] = n
+        eq_(dict(self.t.facets(q)), expected)
+        top = self.t.facets(q, top=3)
+        eq_([c for _, c in top], sorted(expected.values(), reverse=True)[:3])
+        some = tags[:5] + ['missing']
+        eq_(dict(self.t.facets(q, tags=some)),
+            dict((tag, n) for tag, n in expected.iteritems() if tag in some))
+
+    def test_prepare(self):
+        for q in [Tag('water'), And('flying', Or('fire', 'water')), Not('fire'),
+                  And('water', Not('ice')), And('water', 'no-such-tag')]:
+            prepared = self.t.prepare(q)
+            for _ in range(2):
+                eq_(self.t.find(prepared), self.t.find(q))
+                eq_(self.t.count(prepared), self.t.count(q))
+        prepared = self.t.prepare(Or('grass', 'poison'))
+        eq_(set(self.t.iter_query(prepared, batch_size=10)), self.t.find(prepared))
+
+    def test_query_many(self):
+        queries = [Tag('water'), And('flying', Or('fire', 'water')), Not('fire'),
+                   And('water', Not('ice')), Or('fire', 'water'), And('water', 'no-such-tag'),
+                   self.t.prepare(Or('water', 'fire'))]
+        eq_([set(items) for items in self.t.query_many(queries)],
+            [self.t.find(q) for q in queries])
+        eq_(self.t.query_many(queries, count=True), [self.t.count(q) for q in queries])
+        eq_(self.t.query_many([]), [])
+
+    def test_count(self):
+        eq_(self.t.count(Tag('water')), 111)
+        eq_(self.t.count(And('flying', Or('fire', 'water'))), 11)
+        eq_(self.t.count(And('water', 'no-such-tag')), 0)
+
+    def test_iter_query(self):
+        results = list(self.t.iter_query(Or('grass', 'poison'), batch_size=10))
+        eq_(len(results), 119)
+        eq_(set(results), self.t.find(Or('grass', 'poison')))
+
+    def test_page(self):
+        results = []
+        cursor, items = self.t.page(Not('fire'), limit=50)
+        results.extend(items)
+        while cursor:
+            cursor, items = self.t.page(Not('fire'), cursor, limit=50)
+            results.extend(items)
+        eq_(len(results), 599)
+        eq_(set(results), self.t.find(Not('fire')))
+
     @raises(TypeError)
     def test_find_invalid(self):
         self.t.find(Tag('water') & 5)
@@ -87,6 +189,27 @@ class TestMemoryBackend(_TestBackend):
         super(TestMemoryBackend, self).__init__(MemoryTaxon)
 
 
+class TestConcurrentMemoryBackend(_TestBackend):
+    def __init__(self):
+        super(TestConcurrentMemoryBackend, self).__init__(
+            lambda: Taxon(ConcurrentMemoryBackend()))
+
+
+class TestParallelMemoryBackend(_TestBackend):
+    def __init__(self):
+        super(TestParallelMemoryBackend, self).__init__(
+            lambda: Taxon(ParallelMemoryBackend(workers=2, min_items=0)))
+
+    def teardown(self):
+        super(TestParallelMemoryBackend, self).teardown()
+        self.t.backend.close()
+
+
+class TestBitmapBackend(_TestBackend):
+    def __init__(self):
+        super(TestBitmapBackend, self).__init__(BitmapTaxon)
+
+
 class TestRedisBackend(_TestBackend):
     def __init__(self):
         super(TestRedisBackend, self).__init__(TestRedisTaxon)
@@ -97,6 +220,142 @@ class TestRedisBackend(_TestBackend):
             raise RuntimeError("Redis database is not empty")
         super(TestRedisBackend, self).setup()
 
+    def test_query_cached(self):
+        key, results = self.t.query(And('flying', Or('fire', 'water')))
+        eq_(len(results), 11)
+        ok_(self.t.backend.redis.zscore(self.t.backend.cache_key, key))
+        eq_(self.t.backend.redis.scard(key), 11)
+        eq_(self.t.query(And(Or('fire', 'water'), 'flying'))[0], key)
+        stats = self.t.backend.cache_stats()
+        eq_(stats['misses'], 2)
+        eq_(stats['hits'], 1)
+        eq_(stats['size'], 2)
+
+    def test_cache_invalidation(self):
+        r = self.t.backend.redis
+        flying, _ = self.t.query(And('flying', 'fire'))
+        negated, _ = self.t.query(Not('fire'))
+        grass, _ = self.t.query(And('grass', 'poison'))
+        self.t.tag('fire', 'bulbasaur')
+        ok_(not r.exists(flying))
+        ok_(not r.exists(negated))
+        ok_(r.exists(grass))
+        eq_(self.t.find(Not('fire')), set(self.t.items()) - self.t.find(Tag('fire')))
+        negated, _ = self.t.query(Not('fire'))
+        self.t.tag('water', 'new-pokemon')
+        ok_(not r.exists(negated))
+        ok_(r.exists(grass))
+        eq_(len(self.t.find(And('grass', 'poison'))), 14)
+        eq_(self.t.backend.cache_stats()['invalidations'], 3)
+
+    def test_universe(self):
+        backend = self.t.backend
+        universe = backend.redis.smembers(backend.universe_key)
+        eq_(set(backend.decode_many(universe)), set(self.t.items()))
+        self.t.remove('pikachu')
+        self.t.untag('normal', 'snorlax')
+        universe = backend.redis.smembers(backend.universe_key)
+        eq_(set(backend.decode_many(universe)), set(self.t.items()))
+        eq_(len(universe), 647)
+
+    def test_cache_bounds(self):
+        eq_(self.t.backend.cache_size, 10000)
+        self.t.backend.cache_size = 2
+        self.t.backend.cache_ttl = 60
+        r = self.t.backend.redis
+        first, _ = self.t.query(And('flying', 'fire'))
+        ok_(0 < r.ttl(first) <= 60)
+        self.t.query(And('flying', 'water'))
+        self.t.query(And('flying', 'grass'))
+        ok_(not r.exists(first))
+        eq_(r.zcard(self.t.backend.cache_key), 2)
+        eq_(self.t.backend.cache_stats()['evictions'], 1)
+
     def teardown(self):
         super(TestRedisBackend, self).teardown()
         self.t.backend.redis.flushdb()
+
+
+class TestShardedRedisBackend(_TestBackend):
+    def __init__(self):
+        super(TestShardedRedisBackend, self).__init__(TestShardedRedisTaxon)
+
+    def setup(self):
+        t = self.taxon_cls()
+        if any(shard.redis.dbsize() for shard in t.backend.shards):
+            raise RuntimeError("Redis database is not empty")
+        t.backend.close()
+        super(TestShardedRedisBackend, self).setup()
+
+    def teardown(self):
+        super(TestShardedRedisBackend, self).teardown()
+        self.t.backend.close()
+
+
+class TestSQLiteBackend(_TestBackend):
+    def __init__(self):
+        super(TestSQLiteBackend, self).__init__(lambda: SQLiteTaxon(self.path))
+
+    def setup(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'taxon.db')
+        super(TestSQLiteBackend, self).setup()
+
+    def teardown(self):
+        super(TestSQLiteBackend, self).teardown()
+        self.t.backend.close()
+        shutil.rmtree(self.dir)
+
+
+class TestSnapshotBackend(_TestBackend):
+    def __init__(self):
+        super(TestSnapshotBackend, self).__init__(MemoryTaxon)
+
+    def setup(self):
+        super(TestSnapshotBackend, self).setup()
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'taxon.snapshot')
+        self.memory = self.t
+        self.memory.backend.snapshot(self.path)
+        self.t = Taxon(MemoryBackend.open_snapshot(self.path))
+
+    def teardown(self):
+        self.t.backend.close()
+        shutil.rmtree(self.dir)
+
+    def test_matches_memory(self):
+        queries = [Tag('water'), And('flying', Or('fire', 'water')), Not('normal'),
+                   And('grass', Not('poison')), Tag('missing')]
+        for q in queries:
+            eq_(self.t.find(q), self.memory.find(q))
+            eq_(self.t.count(q), self.memory.count(q))
+        eq_(sorted(self.t.tags()), sorted(self.memory.tags()))
+
+    def test_mixed_tag_types(self):
+        # u'\u0100' sorts after '\xc3\xbf' as UTF-8 but cannot be compared to it
+        t = MemoryTaxon()
+        t.tag(u'\u0100', 'x')
+        t.tag('\xc3\xbf', 'y')
+        t.tag('a', 'x', 'y')
+        path = os.path.join(self.dir, 'mixed.snapshot')
+        t.backend.snapshot(path)
+        backend = MemoryBackend.open_snapshot(path)
+        try:
+            snapshot = Taxon(backend)
+            eq_(snapshot.find(Tag(u'\u0100')), set(['x']))
+            eq_(snapshot.find(Tag(u'\xff')), set(['y']))
+            eq_(snapshot.find(Tag('a') & ~Tag('\xc3\xbf')), set(['x']))
+        finally:
+            backend.close()
+
+    @raises(NotImplementedError)
+    def test_read_only(self):
+        self.t.tag('water', 'new-pokemon')
+
+    def test_replace(self):
+        self.memory.tag('water', 'new-pokemon')
+        self.memory.backend.snapshot(self.path)
+        ok_('new-pokemon' not in self.t.find(Tag('water')))
+        t = Taxon(MemoryBackend.open_snapshot(self.path))
+        ok_('new-pokemon' in t.find(Tag('water')))
+        t.backend.close()
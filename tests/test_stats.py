@@ -0,0 +1,124 @@
+import logging
+from nose.tools import raises, eq_, ok_
+from .context import taxon
+from taxon import Taxon, RedisTaxon, ShardedRedisTaxon
+from taxon.backends import BitmapBackend, MemoryBackend
+from taxon.query import *
+from taxon.query import freeze
+from taxon.stats import *
+
+
+def test_histogram():
+    h = Histogram()
+    for seconds in [0.001] * 90 + [0.1] * 10:
+        h.add(seconds)
+    eq_(h.count, 100)
+    ok_(0.001 <= h.percentile(50) < 0.002)
+    ok_(0.1 <= h.percentile(99) <= 0.1)
+    eq_(h.max, 0.1)
+    eq_(Histogram().percentile(50), None)
+
+
+def check_operations(backend):
+    t = Taxon(backend, stats=Stats())
+    t.tag('foo', 'x', 'y')
+    t.tag('bar', 'y')
+    t.untag('foo', 'x')
+    t.query(And('foo', Or('bar', 'baz')))
+    t.find(Not('bar'))
+    t.count(Tag('foo'))
+    stats = t.stats()
+    eq_(stats['operations']['tag']['calls'], 2)
+    eq_(stats['operations']['untag']['calls'], 1)
+    eq_(stats['operations']['query']['calls'], 2)
+    eq_(stats['operations']['query']['counters']['items'], 1)
+    eq_(stats['operations']['count']['errors'], 0)
+    ok_(stats['operations']['tag']['p99'] >= stats['operations']['tag']['p50'])
+    return stats
+
+
+def test_memory_operations():
+    stats = check_operations(MemoryBackend())
+    eq_(stats['nodes']['and']['calls'], 1)
+    ok_(stats['nodes']['tag']['calls'] >= 3)
+
+
+def test_bitmap_operations():
+    stats = check_operations(BitmapBackend())
+    eq_(stats['nodes']['and']['calls'], 1)
+
+
+def test_redis_operations():
+    t = RedisTaxon('redis://localhost:6379/9', 'test')
+    if t.backend.redis.dbsize() > 0:
+        raise RuntimeError("Redis database is not empty")
+    try:
+        stats = check_operations(t.backend)
+        eq_(stats['operations']['tag']['per_call']['redis.round_trips'], 1)
+        eq_(stats['operations']['query']['counters']['cache.misses'], 3)
+        t = Taxon(t.backend, stats=Stats())
+        t.query(And('foo', Or('bar', 'baz')))
+        eq_(t.stats()['counters']['cache.hits'], 1)
+    finally:
+        t.backend.redis.flushdb()
+
+
+def test_sharded_redis_operations():
+    t = ShardedRedisTaxon(['redis://localhost:6379/10', 'redis://localhost:6379/11'], 'test')
+    for shard in t.backend.shards:
+        if shard.redis.dbsize() > 0:
+            raise RuntimeError("Redis database is not empty")
+    try:
+        stats = check_operations(t.backend)
+        eq_(stats['operations']['count']['counters']['redis.round_trips'], 2)
+        # On the shard without 'foo' the intersection ends before its union
+        eq_(stats['operations']['query']['counters']['cache.misses'], 5)
+        eq_(stats['operations']['query']['counters']['redis.round_trips'],
+            stats['counters']['redis.round_trips'] - sum(
+                stats['operations'][op]['counters']['redis.round_trips']
+                for op in ('tag', 'untag', 'count')))
+    finally:
+        t.backend.empty()
+        t.backend.close()
+
+
+def test_errors():
+    t = Taxon(MemoryBackend(), stats=Stats())
+    try:
+        t.query(('bogus', 'foo'))
+    except ValueError:
+        pass
+    eq_(t.stats()['operations']['query']['errors'], 1)
+
+
+def test_no_stats():
+    t = Taxon(MemoryBackend())
+    t.tag('foo', 'x')
+    eq_(t.stats(), None)
+
+
+class Handler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+def test_slow_query_log():
+    handler = Handler()
+    logger = logging.getLogger('taxon.slow_query')
+    logger.addHandler(handler)
+    try:
+        t = Taxon(MemoryBackend(), slow_query_time=0)
+        t.tag('foo', 'x')
+        t.find(And('foo', Not('bar')))
+        eq_(len(handler.messages), 1)
+        ok_(handler.messages[0].startswith('query took'))
+        ok_(handler.messages[0].endswith(repr(freeze(And('foo', Not('bar'))))))
+        t = Taxon(MemoryBackend(), slow_query_time=60)
+        t.find(Tag('foo'))
+        eq_(len(handler.messages), 1)
+    finally:
+        logger.removeHandler(handler)